@@ -1,17 +1,75 @@
 import os
-import requests
 import json
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 from dotenv import load_dotenv
+from cache import DiskCache
+from hf_client import InferenceClient
+import metrics
+from utils import get_annot_hash
 
 load_dotenv()
 
+LLM_MODEL = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+SDXL_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+# Bump whenever the prompt changes so stale cached answers are not served
+PROMPT_VERSION = 1
+
+llm_cache = DiskCache(
+    "llm",
+    max_bytes=int(os.getenv("NOTES_AI_LLM_CACHE_MB", "64")) * 1024 * 1024,
+    ttl=int(os.getenv("NOTES_AI_LLM_CACHE_TTL", str(30 * 24 * 3600))),
+)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Process-wide InferenceClient; HF_API_BASE overrides the endpoint."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = InferenceClient(timeouts={
+                    LLM_MODEL: (10, float(os.getenv("NOTES_AI_LLM_TIMEOUT", "60"))),
+                    SDXL_MODEL: (10, float(os.getenv("NOTES_AI_SDXL_TIMEOUT", "120"))),
+                })
+    return _client
+
+def set_client(client):
+    global _client
+    _client = client
+
 def load_model():
     api_key = os.getenv("HF_API_KEY")
     if not api_key:
         raise ValueError("HF_API_KEY not found in .env file")
     return api_key
 
+def llm_cache_key(annotation, slide_context, slide_number, annot_type):
+    annot_hash = get_annot_hash(annotation, slide_context, slide_number, annot_type)
+    return hashlib.sha256(f"{LLM_MODEL}|{PROMPT_VERSION}|{annot_hash}".encode()).hexdigest()
+
+def is_cacheable(outputs):
+    """Errors and "Failed to generate" placeholders must be retried, never cached."""
+    if not isinstance(outputs, dict) or "error" in outputs:
+        return False
+    return not any(str(value).startswith("Failed to generate") for value in outputs.values())
+
 def generate_creative_outputs(annotation, slide_context, slide_number, annot_type):
+    key = llm_cache_key(annotation, slide_context, slide_number, annot_type)
+    outputs = llm_cache.get(key)
+    if outputs is None:
+        with metrics.span("llm.generate", annotations=1):
+            outputs = _generate_creative_outputs(annotation, slide_context, slide_number, annot_type)
+        if is_cacheable(outputs):
+            llm_cache.set(key, outputs)
+    return outputs
+
+def _generate_creative_outputs(annotation, slide_context, slide_number, annot_type):
     try:
         api_key = load_model()
         headers = {"Authorization": f"Bearer {api_key}"}
@@ -30,15 +88,14 @@ def generate_creative_outputs(annotation, slide_context, slide_number, annot_typ
             "inputs": prompt,
             "parameters": {"max_new_tokens": 350, "temperature": 0.7}
         }
-        response = requests.post(
-            "https://api-inference.huggingface.co/models/mistralai/Mixtral-8x7B-Instruct-v0.1",
-            headers=headers,
-            json=payload
-        )
+        response = get_client().post(LLM_MODEL, payload, headers=headers)
         if response.status_code == 403:
-            return {"error": "⚠️ API access denied. Check HF_API_KEY or rate limits."}
+            return {"error": "⚠️ API access denied. Check HF_API_KEY or rate limits.", "status_code": 403}
         elif response.status_code != 200:
-            return {"error": f"⚠️ API error: {response.status_code} - {response.text}"}
+            return {
+                "error": f"⚠️ API error: {response.status_code} - {response.text}",
+                "status_code": response.status_code,
+            }
         try:
             output = response.json()[0]["generated_text"]
             json_start = output.find("{")
@@ -63,20 +120,207 @@ def generate_creative_outputs(annotation, slide_context, slide_number, annot_typ
     except Exception as e:
         return {"error": f"⚠️ Error: {str(e)}"}
 
+PACK_SIZE = int(os.getenv("NOTES_AI_PACK_SIZE", "8"))
+OUTPUT_FIELDS = ("el5", "mnemonic", "analogy", "diagram_prompt")
+
+def build_packed_prompt(annotations, slide_context, slide_number):
+    lines = [
+        f"You are an expert tutor creating engaging study aids for a student. "
+        f"Slide {slide_number} content: '{slide_context[:500]}'.\n"
+        f"Annotations on this slide:"
+    ]
+    for i, annot in enumerate(annotations, start=1):
+        lines.append(f"{i}. ({annot['type']}): '{annot['text']}'")
+    lines.append(
+        f"Return a JSON array with exactly {len(annotations)} objects, one per annotation and in the same order, each with:\n"
+        f"- 'id': the annotation number.\n"
+        f"- 'el5': A concise, beginner-friendly explanation (max 100 words, simple language).\n"
+        f"- 'mnemonic': A short, memorable phrase to recall the concept.\n"
+        f"- 'analogy': A relatable analogy connecting the concept to daily life (max 100 words).\n"
+        f"- 'diagram_prompt': A short, clear prompt for an AI image generator to create a diagram that visually explains the annotation and its context (max 30 words).\n"
+        f"Ensure the JSON is valid and outputs are clear, creative, and accurate."
+    )
+    return "\n".join(lines)
+
+def parse_packed_outputs(output, count):
+    """
+    Split a packed response into one outputs dict per annotation, in order.
+    Returns None when the array is missing or malformed, or when its items
+    can't be matched to annotations with certainty: the ids must be exactly
+    1..count, or there must be no ids and exactly `count` items.
+    """
+    json_start = output.find("[")
+    json_end = output.rfind("]") + 1
+    if json_start == -1 or json_end == 0:
+        return None
+    try:
+        items = json.loads(output[json_start:json_end])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return None
+    if not any("id" in item for item in items):
+        if len(items) != count:
+            return None
+        by_id = dict(enumerate(items, start=1))
+    else:
+        # Numbering from 0, repeated or missing ids would shift answers onto other annotations
+        try:
+            ids = [int(item["id"]) for item in items]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if sorted(ids) != list(range(1, count + 1)):
+            return None
+        by_id = dict(zip(ids, items))
+    parsed = []
+    for i in range(1, count + 1):
+        item = by_id.get(i)
+        parsed.append({field: item.get(field, "") for field in OUTPUT_FIELDS} if item else None)
+    return parsed
+
+def _generate_packed(annotations, slide_context, slide_number):
+    """
+    One request for several annotations of a slide. Returns a list with one
+    outputs dict (or None where the answer was unusable) per annotation, or
+    an error dict when the request itself failed.
+    """
+    try:
+        api_key = load_model()
+        headers = {"Authorization": f"Bearer {api_key}"}
+        payload = {
+            "inputs": build_packed_prompt(annotations, slide_context, slide_number),
+            "parameters": {
+                "max_new_tokens": min(350 * len(annotations), 2048),
+                "temperature": 0.7,
+                "return_full_text": False,
+            }
+        }
+        response = get_client().post(LLM_MODEL, payload, headers=headers)
+        if response.status_code == 403:
+            return {"error": "⚠️ API access denied. Check HF_API_KEY or rate limits.", "status_code": 403}
+        elif response.status_code != 200:
+            return {
+                "error": f"⚠️ API error: {response.status_code} - {response.text}",
+                "status_code": response.status_code,
+            }
+        try:
+            output = response.json()[0]["generated_text"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            return [None] * len(annotations)
+        return parse_packed_outputs(output, len(annotations)) or [None] * len(annotations)
+    except Exception as e:
+        return {"error": f"⚠️ Error: {str(e)}"}
+
+def generate_creative_outputs_batch(annotations, slide_context, slide_number):
+    """
+    Study aids for all `annotations` of one slide, packed PACK_SIZE per
+    request so the shared slide context is only sent once per pack.
+    Returns {key: outputs}. Annotations the model didn't answer properly
+    fall back to individual generate_creative_outputs calls.
+    """
+    results = {}
+    pending = []
+    for annot in annotations:
+        cached = llm_cache.get(llm_cache_key(annot["text"], slide_context, slide_number, annot["type"]))
+        if cached is None:
+            pending.append(annot)
+        else:
+            results[annot["key"]] = cached
+
+    for start in range(0, len(pending), PACK_SIZE):
+        pack = pending[start:start + PACK_SIZE]
+        if len(pack) > 1:
+            with metrics.span("llm.packed", annotations=len(pack)):
+                packed = _generate_packed(pack, slide_context, slide_number)
+        else:
+            packed = [None]
+        if isinstance(packed, dict):
+            for annot in pack:
+                results[annot["key"]] = packed
+            continue
+        for annot, outputs in zip(pack, packed):
+            if is_cacheable(outputs) and all(outputs.get(field) for field in OUTPUT_FIELDS[:3]):
+                llm_cache.set(llm_cache_key(annot["text"], slide_context, slide_number, annot["type"]), outputs)
+                results[annot["key"]] = outputs
+            else:
+                results[annot["key"]] = generate_creative_outputs(
+                    annot["text"], slide_context, slide_number, annot["type"]
+                )
+    return results
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def _generate_rate_limited(annot, bucket):
+    bucket.acquire()
+    return {annot["key"]: generate_creative_outputs(annot["text"], annot["context"], annot["page"], annot["type"])}
+
+def _generate_slide_rate_limited(annots, bucket):
+    bucket.acquire()
+    return generate_creative_outputs_batch(annots, annots[0]["context"], annots[0]["page"])
+
+def iter_creative_outputs(annotations, max_concurrency=4, rate=2.0, pack=True, plan=None):
+    """
+    Generate study aids for many annotations concurrently, yielding
+    (key, outputs) as each one finishes. With `pack`, annotations of the same
+    slide share one request (see generate_creative_outputs_batch). At most
+    `max_concurrency` requests are in flight and at most `rate` are started
+    per second; 429 and 503 responses are retried by the InferenceClient.
+
+    With a dedupe.GenerationPlan as `plan`, only its representatives are
+    generated and each result is yielded for every key of its cluster.
+    """
+    if plan is not None:
+        with closing(iter_creative_outputs(plan.representatives, max_concurrency, rate, pack)) as results:
+            for key, outputs in results:
+                for member in plan.members.get(key, [key]):
+                    yield member, outputs
+        return
+    bucket = TokenBucket(rate)
+    pool = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        if pack:
+            by_slide = {}
+            for annot in annotations:
+                by_slide.setdefault(annot["page"], []).append(annot)
+            futures = [pool.submit(_generate_slide_rate_limited, annots, bucket) for annots in by_slide.values()]
+        else:
+            futures = [pool.submit(_generate_rate_limited, annot, bucket) for annot in annotations]
+        for future in as_completed(futures):
+            yield from future.result().items()
+    finally:
+        # Don't keep generating if the caller stops listening (e.g. a Streamlit rerun)
+        pool.shutdown(wait=False, cancel_futures=True)
+
 def generate_diagram_image_sdxl(diagram_prompt):
+    with metrics.span("sdxl.generate"):
+        return _generate_diagram_image_sdxl(diagram_prompt)
+
+def _generate_diagram_image_sdxl(diagram_prompt):
     try:
         api_key = load_model()
         headers = {"Authorization": f"Bearer {api_key}"}
         payload = {"inputs": diagram_prompt}
-        response = requests.post(
-            "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0",
-            headers=headers,
-            json=payload,
-            timeout=120,
-        )
-        print(f"Status code: {response.status_code}")
-        print(f"Headers: {response.headers}")
-        print(f"Content type: {response.headers.get('content-type')}")
+        response = get_client().post(SDXL_MODEL, payload, headers=headers)
 
         if response.status_code == 200 and response.headers.get("content-type", "").startswith("image"):
             return response.content
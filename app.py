@@ -1,10 +1,18 @@
 import streamlit as st
-import pymupdf
 import os
-from ai import generate_creative_outputs, generate_diagram_image_sdxl, load_model
-from ocr import extract_handwritten_text, run_full_page_ocr
+import uuid
+from contextlib import closing
+from ai import generate_creative_outputs, is_cacheable, iter_creative_outputs, load_model
+from dedupe import plan_generations
+from diagrams import DiagramJobQueue, StoredImages
+from ocr import iter_full_page_ocr, prewarm_reader
+from extraction import extract_annotations
+from ingest import DocumentTooLarge, MUPDF_LOCK, open_document, spill, touch
+from render import RenderCache, VIEWER_SCALE, neighbours
 from utils import get_annot_hash
-from export import export_notes_md, export_notes_md_images, get_diagrams_zip
+from model import AnnotatedDocument
+import metrics
+from export import EXPORT_FORMATS, export_fingerprint, export_path, prepare_export
 
 os.environ["STREAMLIT_CONFIG_DIR"] = "/tmp/.streamlit"
 os.environ["STREAMLIT_CACHE_DIR"] = "/tmp/.streamlit/cache"
@@ -21,150 +29,314 @@ st.markdown(
     """
 )
 
+@st.cache_resource
+def prewarm_ocr():
+    # Load the OCR models once per process, off the script thread
+    return prewarm_reader()
+
+
+if os.getenv("NOTES_AI_PREWARM_OCR") == "1":
+    prewarm_ocr()
+
+
+@st.cache_resource
+def start_metrics_server(port):
+    # Prometheus scrape endpoint at :<port>/metrics, once per process
+    metrics.enable()
+    return metrics.serve(port)
+
+
+if os.getenv("NOTES_AI_METRICS_PORT"):
+    start_metrics_server(int(os.getenv("NOTES_AI_METRICS_PORT")))
+
+
+def show_debug_panel(doc_hash):
+    with st.sidebar.expander("Timing breakdown", expanded=True):
+        st.caption("Timings come from one log shared by the whole server, so they include "
+                   "work done for other sessions at the same time.")
+        upload_rows = st.session_state["timings"].get(doc_hash)
+        if upload_rows:
+            st.caption("Processing this upload")
+            st.dataframe(upload_rows, hide_index=True)
+        st.caption("This rerun")
+        st.dataframe(metrics.registry.breakdown(since=st.session_state["rerun_mark"]), hide_index=True)
+        hit_rates = metrics.registry.hit_rates()
+        if hit_rates:
+            st.caption("Cache hit rates")
+            st.json({name: f"{rate:.0%}" for name, rate in hit_rates.items()})
+        st.download_button("Metrics (Prometheus)", metrics.registry.to_prometheus(), file_name="metrics.txt")
+        st.download_button("Metrics (JSON)", metrics.registry.to_json(), file_name="metrics.json")
+
+MAX_CACHED_DOCS = int(os.getenv("NOTES_AI_MAX_CACHED_DOCS", "4"))
+
+
+@st.cache_data(max_entries=MAX_CACHED_DOCS, show_spinner="Extracting annotations...")
+def parse_document(doc_hash, _pdf_path):
+    # Keyed by content hash only; the file itself is not hashed again
+    return extract_annotations(_pdf_path)
+
+
+def ingest_upload(uploaded_file):
+    # Spill each upload to disk once, not on every rerun; returns (sha256, path)
+    uploads = st.session_state.setdefault("uploads", {})
+    file_id = getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}-{uploaded_file.size}"
+    if file_id not in uploads or not os.path.exists(uploads[file_id][1]):
+        uploads[file_id] = spill(uploaded_file)
+    else:
+        # Still in use: keep other sessions' uploads from pruning it
+        touch(uploads[file_id][1])
+    return uploads[file_id]
+
+
+@st.cache_resource
+def get_render_cache():
+    # One render cache per process, shared by all sessions
+    return RenderCache()
+
+
+@st.cache_resource
+def get_diagram_queue():
+    # One job queue and image store per process; identical prompts share a job
+    return DiagramJobQueue()
+
+
+def diagram_status(job_id):
+    status = get_diagram_queue().status(job_id)
+    if status["status"] in ("done", "failed"):
+        st.rerun()
+    st.info(f"Diagram {status['status']}...")
+
+
+# Poll pending jobs without blocking the rest of the page
+if hasattr(st, "fragment"):
+    diagram_status = st.fragment(run_every=2)(diagram_status)
+
+
+EXPORT_LABELS = {
+    "md": "Study Guide as Markdown",
+    "md_images": "Study Guide (Markdown + Diagrams)",
+    "bundle": "Study Guide + Diagram Files (ZIP)",
+    "diagrams": "All Diagrams as ZIP",
+}
+
+
+def clear_document_cache():
+    parse_document.clear()
+    st.session_state["ocr_results"] = {}
+    st.session_state["ocr_partial"] = {}
+    st.session_state["ocr_cancelled"] = set()
+    st.session_state["uploads"] = {}
+
+
 if "selected_annots" not in st.session_state:
     st.session_state["selected_annots"] = {}
 if "ai_outputs" not in st.session_state:
     st.session_state["ai_outputs"] = {}
-if "diagram_images" not in st.session_state:
-    st.session_state["diagram_images"] = {}
-
-
-def get_annotations_from_pdf(doc):
-    annotations_by_slide = {}
-    for page_number, page in enumerate(doc, start=1):
-        slide_context = page.get_text().strip().replace('\n', ' ')
-        annot = page.first_annot
-        while annot:
-            annot_type = annot.type[0]
-            content = annot.info.get("content", "")
-            annot_label = None
-
-            if annot_type == 1:
-                annot_label = "Sticky Note"
-            elif annot_type == 2:
-                annot_label = "FreeText"
-            elif annot_type == 8:
-                from utils import extract_highlighted_text
-                content = extract_highlighted_text(page, annot)
-                annot_label = "Highlight"
-            elif annot_type == 9:
-                annot_label = "Handwritten"
-                rect = annot.rect
-                clip = page.get_pixmap(matrix=pymupdf.Matrix(2, 2), clip=rect)
-                content = extract_handwritten_text(clip.tobytes("png"))
-            else:
-                annot_label = None
-
-            if annot_label and content:
-                key = f"{page_number}-{annot.xref}"
-                priority = 2 if "?" in content else 1
-                annotation_data = {
-                    "page": page_number,
-                    "type": annot_label,
-                    "text": content,
-                    "context": slide_context,
-                    "key": key,
-                    "priority": priority
-                }
-                annotations_by_slide.setdefault(page_number, []).append(annotation_data)
-            annot = annot.next
-    return annotations_by_slide
+if "diagram_jobs" not in st.session_state:
+    st.session_state["diagram_jobs"] = {}
+if "exports" not in st.session_state:
+    st.session_state["exports"] = {}
+if "ocr_results" not in st.session_state:
+    st.session_state["ocr_results"] = {}
+if "ocr_partial" not in st.session_state:
+    st.session_state["ocr_partial"] = {}
+if "ocr_cancelled" not in st.session_state:
+    st.session_state["ocr_cancelled"] = set()
+if "timings" not in st.session_state:
+    st.session_state["timings"] = {}
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+if "debug" not in st.session_state:
+    st.session_state["debug"] = metrics.forced()
+st.session_state["rerun_mark"] = metrics.registry.mark()
 
 
 uploaded_file = st.file_uploader("Upload an annotated PDF", type="pdf")
 
 if uploaded_file:
-    pdf_bytes = uploaded_file.read()
-    doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
-
-    # Try extracting annotations with PyMuPDF first
-    annotations_by_slide = get_annotations_from_pdf(doc)
+    try:
+        doc_hash, pdf_path = ingest_upload(uploaded_file)
+        # Opened by path: MuPDF reads pages from the file as they are used.
+        # Prefetch threads may be rendering: MuPDF calls here hold MUPDF_LOCK
+        with MUPDF_LOCK:
+            doc = open_document(pdf_path)
+            page_count = doc.page_count
+    except DocumentTooLarge as e:
+        st.error(str(e))
+        st.stop()
+    try:
+        renders = get_render_cache()
+        diagram_queue = get_diagram_queue()
+        st.sidebar.button("Clear cached documents", on_click=clear_document_cache)
+        debug = st.sidebar.checkbox("Debug: show timings", key="debug")
+        # Metrics stay on only while some session has timings open (or NOTES_AI_METRICS is set)
+        metrics.hold(st.session_state["session_id"], debug)
+        upload_mark = metrics.registry.mark()
 
-    #Then Try OCR if fails PyMuPDF
-    if not annotations_by_slide:
-        st.warning("No standard annotations found in the PDF. Running full-page OCR, this might take some time...")
-        annotations_by_slide = run_full_page_ocr(doc, st)
+        # Try extracting annotations with PyMuPDF first
+        with MUPDF_LOCK:
+            annotations_by_slide = parse_document(doc_hash, pdf_path)
 
-        #If OCR fails as well
+        #Then Try OCR if fails PyMuPDF
         if not annotations_by_slide:
-            st.error("No text detected via OCR either. Please try a different PDF or check your file.")
-    else:
-        slide_numbers = list(annotations_by_slide.keys())
-        selected_slide = st.sidebar.selectbox("Select Slide", slide_numbers)
-
-        slide = doc[selected_slide - 1]
-        st.image(
-            slide.get_pixmap(matrix=pymupdf.Matrix(1.5, 1.5)).tobytes("png"),
-            caption=f"Slide {selected_slide}",
-            width=600
-        )
-        st.subheader(f"Annotations for Slide {selected_slide}")
-
-        for annot in sorted(annotations_by_slide[selected_slide], key=lambda x: x["priority"], reverse=True):
-            key = annot["key"]
-            with st.expander(f"{annot['type']}: {annot['text'][:60]}"):
-                st.markdown(f"**Annotation:** {annot['text']}")
-                if st.button(f"Generate AI for slide {key}", key=f"gen-{key}"):
-                    ai_outputs = generate_creative_outputs(
-                        annot["text"], annot["context"], annot["page"], annot["type"]
-                    )
-                    st.session_state[f"ai_{key}"] = ai_outputs
-
-                if f"ai_{key}" in st.session_state:
-                    ai_outputs = st.session_state[f"ai_{key}"]
-                    if "error" in ai_outputs:
-                        st.error(ai_outputs["error"])
-                    else:
-                        st.markdown("**AI Suggestions:**")
-                        el5 = st.text_area("ELI5 Explanation", ai_outputs.get('el5', ''), key=f"el5_{key}")
-                        mnemonic = st.text_area("Mnemonic", ai_outputs.get('mnemonic', ''), key=f"mnemonic_{key}")
-                        analogy = st.text_area("Analogy", ai_outputs.get('analogy', ''), key=f"analogy_{key}")
-
-                        default_prompt = ai_outputs.get('diagram_prompt', '')
-                        diagram_prompt = st.text_input(
-                            "Diagram Prompt (edit or write your own):",
-                            value=default_prompt if default_prompt else "",
-                            key=f"diagram_prompt_{key}"
+            ocr_results = st.session_state["ocr_results"]
+            if doc_hash not in ocr_results:
+                # Pages finished so far survive reruns and cancellation
+                partial = st.session_state["ocr_partial"].setdefault(doc_hash, {})
+                cancelled = doc_hash in st.session_state["ocr_cancelled"]
+                if not cancelled:
+                    st.warning("No standard annotations found in the PDF. Running full-page OCR, results appear slide by slide...")
+                    st.button("Cancel OCR", on_click=st.session_state["ocr_cancelled"].add, args=(doc_hash,))
+                    remaining = [n for n in range(1, page_count + 1) if n not in partial]
+                    progress = st.progress(len(partial) / page_count, text="Running OCR...")
+                    # The pipeline renders on its own thread; don't touch `doc` while it runs
+                    with closing(iter_full_page_ocr(doc, renders, doc_hash, pages=remaining)) as pages:
+                        for page_number, annotations, highlighted_texts, error in pages:
+                            if error is not None:
+                                st.error(f"❌ Error on slide {page_number}: {error}")
+                                partial[page_number] = []
+                            else:
+                                partial[page_number] = annotations
+                                with st.expander(f"Slide {page_number}: {annotations[0]['text'][:60]}"):
+                                    st.markdown(annotations[0]["text"])
+                                    for i, snippet in enumerate(highlighted_texts, 1):
+                                        st.write(f"Highlighted {i}. {snippet}")
+                            progress.progress(len(partial) / page_count, text=f"OCR done for {len(partial)}/{page_count} slides")
+                else:
+                    st.info(f"OCR cancelled after {len(partial)} of {page_count} slides; showing what was recognised.")
+
+                annotations_by_slide = AnnotatedDocument({n: partial[n] for n in sorted(partial) if partial[n]}).dedupe_keys()
+                if not cancelled:
+                    ocr_results[doc_hash] = annotations_by_slide
+                    st.session_state["ocr_partial"].pop(doc_hash, None)
+                    while len(ocr_results) > MAX_CACHED_DOCS:
+                        ocr_results.pop(next(iter(ocr_results)))
+            else:
+                annotations_by_slide = ocr_results[doc_hash]
+
+            #If OCR fails as well
+            if not annotations_by_slide:
+                st.error("No text detected via OCR either. Please try a different PDF or check your file.")
+
+        if debug and doc_hash not in st.session_state["timings"]:
+            # Only the first, uncached pass over a document records any stages
+            upload_rows = metrics.registry.breakdown(since=upload_mark)
+            if upload_rows:
+                st.session_state["timings"][doc_hash] = upload_rows
+
+        if annotations_by_slide:
+            slide_numbers = list(annotations_by_slide.keys())
+            selected_slide = st.sidebar.selectbox("Select Slide", slide_numbers)
+
+            st.image(
+                renders.render(doc, doc_hash, selected_slide, VIEWER_SCALE, reuse_larger=True),
+                caption=f"Slide {selected_slide}",
+                width=600
+            )
+            renders.prefetch(pdf_path, doc_hash, neighbours(slide_numbers, selected_slide))
+
+            strip = sorted(neighbours(slide_numbers, selected_slide, radius=3) + [selected_slide])
+            st.sidebar.image(
+                [renders.thumbnail(doc, doc_hash, n) for n in strip],
+                caption=[f"Slide {n}" for n in strip],
+                width=120
+            )
+            st.sidebar.markdown("---")
+            bulk_scope = st.sidebar.radio("Bulk generation", ["Current slide", "Whole document"])
+            if st.sidebar.button("Generate AI for all annotations"):
+                if bulk_scope == "Current slide":
+                    bulk_annots = list(annotations_by_slide[selected_slide])
+                else:
+                    bulk_annots = annotations_by_slide.annotations()
+                # Failed generations (error dicts, placeholders) are retried too
+                pending = [a for a in bulk_annots if not is_cacheable(st.session_state.get(f"ai_{a['key']}"))]
+                if pending:
+                    # Near-identical annotations are generated once and share the outputs
+                    plan = plan_generations(pending)
+                    progress = st.sidebar.progress(0.0, text=f"Generating 0/{len(pending)}")
+                    for done, (key, ai_outputs) in enumerate(iter_creative_outputs(pending, plan=plan), start=1):
+                        st.session_state[f"ai_{key}"] = ai_outputs
+                        progress.progress(done / len(pending), text=f"Generating {done}/{len(pending)}")
+                    if plan.saved:
+                        st.sidebar.caption(f"{plan.saved} of {len(pending)} generations skipped: "
+                                           "near-duplicate annotations share one result.")
+                else:
+                    st.sidebar.info("All annotations already have AI outputs.")
+
+            st.subheader(f"Annotations for Slide {selected_slide}")
+
+            for annot in sorted(annotations_by_slide[selected_slide], key=lambda x: x["priority"], reverse=True):
+                key = annot["key"]
+                with st.expander(f"{annot['type']}: {annot['text'][:60]}"):
+                    st.markdown(f"**Annotation:** {annot['text']}")
+                    if st.button(f"Generate AI for slide {key}", key=f"gen-{key}"):
+                        ai_outputs = generate_creative_outputs(
+                            annot["text"], annot["context"], annot["page"], annot["type"]
                         )
+                        st.session_state[f"ai_{key}"] = ai_outputs
 
-                        if st.button(f"Generate Diagram for {key}", key=f"diagram-{key}"):
-                            with st.spinner("Generating diagram..."):
-                                image_bytes = generate_diagram_image_sdxl(diagram_prompt)
-                                if image_bytes:
-                                    st.session_state["diagram_images"][key] = image_bytes
+                    if f"ai_{key}" in st.session_state:
+                        ai_outputs = st.session_state[f"ai_{key}"]
+                        if "error" in ai_outputs:
+                            st.error(ai_outputs["error"])
+                        else:
+                            st.markdown("**AI Suggestions:**")
+                            el5 = st.text_area("ELI5 Explanation", ai_outputs.get('el5', ''), key=f"el5_{key}")
+                            mnemonic = st.text_area("Mnemonic", ai_outputs.get('mnemonic', ''), key=f"mnemonic_{key}")
+                            analogy = st.text_area("Analogy", ai_outputs.get('analogy', ''), key=f"analogy_{key}")
+
+                            default_prompt = ai_outputs.get('diagram_prompt', '')
+                            diagram_prompt = st.text_input(
+                                "Diagram Prompt (edit or write your own):",
+                                value=default_prompt if default_prompt else "",
+                                key=f"diagram_prompt_{key}"
+                            )
+
+                            if st.button(f"Generate Diagram for {key}", key=f"diagram-{key}"):
+                                st.session_state["diagram_jobs"][key] = diagram_queue.submit(diagram_prompt)
+
+                            job_id = st.session_state["diagram_jobs"].get(key)
+                            if job_id:
+                                job = diagram_queue.status(job_id)
+                                image_path = diagram_queue.image_path(job_id)
+                                if image_path:
+                                    st.image(image_path, caption="AI-Generated Diagram")
+                                elif job["status"] in ("failed", "done", "unknown"):
+                                    st.error(f"Failed to generate diagram: {job['error'] or 'image no longer available'}. "
+                                             "Please check your prompt and try again.")
+                                elif hasattr(st, "fragment"):
+                                    diagram_status(job_id)
                                 else:
-                                    st.error("Failed to generate diagram. Please check your prompt and try again.")
-                                    st.session_state["diagram_images"][key] = None
-
-                        img_bytes = st.session_state["diagram_images"].get(key)
-                        if img_bytes:
-                            st.image(img_bytes, caption="AI-Generated Diagram")
-
-        md_notes = export_notes_md(annotations_by_slide)
-        st.download_button(
-            "Download Study Guide as Markdown",
-            data=md_notes,
-            file_name="study_notes.md",
-            mime="text/markdown"
-        )
-
-        md_notes_img = export_notes_md_images(annotations_by_slide)
-        st.download_button(
-            "Download Study Guide (Markdown + Diagrams)",
-            data=md_notes_img,
-            file_name="study_notes_with_diagrams.md",
-            mime="text/markdown"
-        )
-
-        if st.session_state["diagram_images"]:
-            zip_buffer = get_diagrams_zip(st.session_state["diagram_images"])
-            st.download_button(
-                "Download All Diagrams as ZIP",
-                data=zip_buffer,
-                file_name="diagrams.zip",
-                mime="application/zip"
-            )
+                                    st.info(f"Diagram {job['status']}...")
+                                    st.button("Refresh", key=f"diagram-refresh-{key}")
+
+            # Exports are built only on request, into files reused while the notes are unchanged
+            st.markdown("---")
+            diagram_images = StoredImages(diagram_queue, st.session_state["diagram_jobs"])
+            formats = [f for f in EXPORT_LABELS if f != "diagrams" or diagram_images]
+            export_format = st.selectbox("Export", formats, format_func=EXPORT_LABELS.get)
+            prepared = st.session_state["exports"]
+            if st.button("Prepare export"):
+                with st.spinner("Building export..."):
+                    prepared[(doc_hash, export_format)] = prepare_export(export_format, annotations_by_slide, diagram_images=diagram_images)
+            path = prepared.get((doc_hash, export_format))
+            if path and os.path.exists(path):
+                current = export_path(export_format, export_fingerprint(export_format, annotations_by_slide, diagram_images=diagram_images))
+                if path != current:
+                    st.caption("Notes changed since this export was prepared; prepare it again to include the changes.")
+                file_name, mime, _ = EXPORT_FORMATS[export_format]
+                with open(path, "rb") as f:
+                    st.download_button(f"Download {EXPORT_LABELS[export_format]}", data=f, file_name=file_name, mime=mime)
+
+        if debug:
+            show_debug_panel(doc_hash)
+    finally:
+        # Closed under the lock: left to GC, MuPDF could free it while a prefetch renders
+        with MUPDF_LOCK:
+            doc.close()
 else:
+    # No upload means no timings on screen: stop holding metrics on for this session
+    metrics.hold(st.session_state["session_id"], False)
     st.info("Upload an annotated PDF to get started.")
 
 st.markdown("---")
@@ -0,0 +1,654 @@
+import argparse
+import ctypes
+import gc
+import glob
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pymupdf
+from PIL import Image
+from utils import extract_highlighted_text, PageWordIndex
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+LOREM = (
+    "Gibbs free energy determines whether a reaction is spontaneous at constant "
+    "temperature and pressure enthalpy entropy equilibrium constant activation "
+    "energy catalyst rate law half life kinetic thermodynamic control"
+).split()
+
+
+def make_synthetic_pdf(pages=500, highlights_per_page=8, lines_per_page=30, ink_per_page=0, notes_per_page=0,
+                       marks_per_page=0):
+    """
+    Build an annotated lecture-style deck in memory and return its bytes.
+    "Ink" annotations are annotation type 9, which the extractor treats as
+    handwriting and rasterizes for OCR; notes are FreeText annotations.
+    Marks are type 9 annotations with no text under them: alternately a
+    rule in the empty right margin and a tiny tick.
+    """
+    doc = pymupdf.open()
+    for p in range(pages):
+        page = doc.new_page()
+        y = 60
+        for i in range(lines_per_page):
+            words = [LOREM[(p + i + j) % len(LOREM)] for j in range(10)]
+            page.insert_text((50, y), " ".join(words), fontsize=11)
+            y += 22
+        line_rects = [r for r in (page.search_for(LOREM[(p + i) % len(LOREM)]) or [])]
+        for r in line_rects[:highlights_per_page]:
+            page.add_highlight_annot(r)
+        for i in range(ink_per_page):
+            top = 60 + (i * 5 % lines_per_page) * 22
+            page.add_underline_annot(pymupdf.Rect(50, top - 12, 350, top + 6))
+        for i in range(marks_per_page):
+            top = 80 + i * 60
+            if i % 2:
+                page.add_underline_annot(pymupdf.Rect(560, top, 564, top + 4))
+            else:
+                page.add_underline_annot(pymupdf.Rect(470, top, 590, top + 14))
+        for i in range(notes_per_page):
+            page.add_freetext_annot(pymupdf.Rect(400, 60 + i * 40, 590, 95 + i * 40),
+                                    f"What does {LOREM[(p + i) % len(LOREM)]} mean?", fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _naive_extract_highlighted_text(page, annot):
+    # Pre-index implementation, kept as the reference for equality and timing
+    quads = annot.vertices
+    quad_count = int(len(quads) / 4)
+    highlighted_chunks = []
+    words = page.get_text("words")
+    for i in range(quad_count):
+        highlight_rect = pymupdf.Quad(quads[i*4:(i+1)*4]).rect
+        chunk_words = []
+        for word in words:
+            word_rect = pymupdf.Rect(word[:4])
+            intersect = word_rect & highlight_rect
+            if intersect:
+                word_area = word_rect.width * word_rect.height
+                overlap_area = intersect.width * intersect.height
+                if word_area and overlap_area / word_area > 0.5:
+                    chunk_words.append(word[4])
+        chunk = " ".join(chunk_words)
+        if chunk and len(chunk) > 2:
+            highlighted_chunks.append(chunk)
+    return " / ".join(highlighted_chunks)
+
+
+def _highlights(doc):
+    for page in doc:
+        annots = [a for a in page.annots() if a.type[0] == 8]
+        if annots:
+            yield page, annots
+
+
+def bench_highlights(doc):
+    start = time.perf_counter()
+    naive = [_naive_extract_highlighted_text(page, a) for page, annots in _highlights(doc) for a in annots]
+    naive_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = []
+    for page, annots in _highlights(doc):
+        word_index = PageWordIndex(page)
+        indexed.extend(extract_highlighted_text(page, a, word_index) for a in annots)
+    indexed_s = time.perf_counter() - start
+
+    return {
+        "highlights": len(naive),
+        "naive_s": round(naive_s, 4),
+        "indexed_s": round(indexed_s, 4),
+        "speedup": round(naive_s / indexed_s, 2) if indexed_s else None,
+        "identical": naive == indexed,
+    }
+
+
+def _clips(doc):
+    clips = []
+    for page in doc:
+        for annot in page.annots():
+            if annot.type[0] == 9:
+                clips.append(page.get_pixmap(matrix=pymupdf.Matrix(2, 2), clip=annot.rect).tobytes("png"))
+    return clips
+
+
+def bench_ocr_batch(doc, batch_size=16):
+    import ocr
+
+    clips = _clips(doc)
+    if not clips:
+        return {"clips": 0}
+    ocr.ocr_cache.clear()
+    start = time.perf_counter()
+    single = [ocr.extract_handwritten_text(c) for c in clips]
+    single_s = time.perf_counter() - start
+
+    ocr.ocr_cache.clear()
+    start = time.perf_counter()
+    batched = ocr.extract_handwritten_text_batch(clips, batch_size)
+    batched_s = time.perf_counter() - start
+    ocr.ocr_cache.clear()
+
+    return {
+        "clips": len(clips),
+        "per_clip_clips_per_s": round(len(clips) / single_s, 2),
+        "batched_clips_per_s": round(len(clips) / batched_s, 2),
+        "speedup": round(single_s / batched_s, 2),
+        "same_text": single == batched,
+    }
+
+
+def bench_clip_filter(doc):
+    """
+    OCR calls and per-clip preparation time for ink clips: the fixed 2x PNG
+    render that used to feed OCR vs render_clip's adaptive scale, zero-copy
+    array and blank/line pre-filter. OCR itself is not timed; every avoided
+    call saves one EasyOCR pass.
+    """
+    import ocr
+
+    rects = [(page, annot.rect) for page in doc for annot in page.annots() if annot.type[0] == 9]
+    if not rects:
+        return {"clips": 0}
+    start = time.perf_counter()
+    pixels_before = 0
+    for page, rect in rects:
+        png = page.get_pixmap(matrix=pymupdf.Matrix(2, 2), clip=rect).tobytes("png")
+        image = np.array(Image.open(io.BytesIO(png)).convert("RGB"))
+        pixels_before += image.shape[0] * image.shape[1]
+    before_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kept, pixels_after, reasons = 0, 0, {}
+    for page, rect in rects:
+        pix, rejected = ocr.render_clip(page, rect)
+        if rejected:
+            reasons[rejected] = reasons.get(rejected, 0) + 1
+        else:
+            kept += 1
+            pixels_after += pix.width * pix.height
+    after_s = time.perf_counter() - start
+
+    return {
+        "clips": len(rects),
+        "ocr_calls_before": len(rects),
+        "ocr_calls_after": kept,
+        "avoided_pct": round(100 * (len(rects) - kept) / len(rects), 1),
+        "skipped": reasons,
+        "before_ms_per_clip": round(1000 * before_s / len(rects), 3),
+        "after_ms_per_clip": round(1000 * after_s / len(rects), 3),
+        "ocr_kpixels_before": pixels_before // 1000,
+        "ocr_kpixels_after": pixels_after // 1000,
+    }
+
+
+def check_clip_filter():
+    """Edge cases of ocr.render_clip: off-page ink is blank, narrow glyphs are kept, rules are lines."""
+    import ocr
+
+    doc = pymupdf.open()
+    page = doc.new_page(width=612, height=792)
+    page.insert_text((100, 130), "1", fontsize=24)
+    page.insert_text((200, 130), "l", fontsize=24)
+    page.draw_line((100, 210), (400, 210), width=1)
+    cases = {
+        "off_page": (pymupdf.Rect(700, 900, 760, 960), "blank"),
+        "digit_1": (pymupdf.Rect(95, 105, 120, 135), None),
+        "letter_l": (pymupdf.Rect(195, 105, 215, 135), None),
+        "rule": (pymupdf.Rect(90, 200, 410, 220), "line"),
+    }
+    results = {name: ocr.render_clip(page, rect)[1] for name, (rect, _) in cases.items()}
+    doc.close()
+    failed = {name: got for name, got in results.items() if got != cases[name][1]}
+    assert not failed, f"unexpected clip rejections: {failed}"
+    return results
+
+
+def bench_llm_packing(slides=5, per_slide=8, latency=0.3):
+    """Bytes sent per annotation and latency per slide, one request per annotation vs packed per slide."""
+    import ai
+    from fake_hf import FakeHFServer
+    from hf_client import InferenceClient
+
+    os.environ.setdefault("HF_API_KEY", "bench")
+    context = " ".join(LOREM * 4)
+    results = {}
+    with FakeHFServer(latency=latency) as server:
+        ai.set_client(InferenceClient(base_url=server.url))
+        for mode in ("per_annotation", "packed"):
+            ai.llm_cache.clear()
+            server.bytes_received = 0
+            start = time.perf_counter()
+            for slide in range(1, slides + 1):
+                annots = [{"text": f"{LOREM[i]} {slide}", "context": context, "page": slide,
+                           "type": "Highlight", "key": f"{slide}-{i}"} for i in range(per_slide)]
+                if mode == "packed":
+                    ai.generate_creative_outputs_batch(annots, context, slide)
+                else:
+                    for a in annots:
+                        ai.generate_creative_outputs(a["text"], context, slide, a["type"])
+            elapsed = time.perf_counter() - start
+            results[f"{mode}_bytes_per_annotation"] = server.bytes_received // (slides * per_slide)
+            results[f"{mode}_s_per_slide"] = round(elapsed / slides, 3)
+        ai.llm_cache.clear()
+        ai.set_client(None)
+    return results
+
+
+STARTUP_PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+import ocr
+if sys.argv[1] == "eager":
+    ocr.get_reader()
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def bench_startup():
+    """Import cost of the OCR module, lazy (as shipped) vs with the reader loaded eagerly."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for mode in ("lazy", "eager"):
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE, mode], cwd=here,
+                             capture_output=True, text=True, check=True).stdout.split()
+        results[f"{mode}_import_s"] = round(float(out[0]), 3)
+        results[f"{mode}_max_rss_mb"] = round(int(out[1]) / 1024, 1)
+    return results
+
+
+def bench_annotation_memory(doc):
+    """
+    Bytes per annotation held as dicts (the old representation) vs model.Annotation
+    records, plus the serialized size of the document both ways. Text and
+    context strings exist before tracing starts, so only the containers count.
+    """
+    from extraction import get_annotations_from_pdf
+    from model import Annotation, AnnotatedDocument
+
+    document = get_annotations_from_pdf(doc)
+    count = len(document.annotations())
+    builders = {
+        "dict": lambda: {n: [a.to_dict() for a in annots] for n, annots in document.items()},
+        "record": lambda: AnnotatedDocument({n: [Annotation(a.page, a.type, a.text, a.key, a.priority, document.page_texts)
+                                                 for a in annots] for n, annots in document.items()}),
+    }
+    results = {"annotations": count}
+    for name, build in builders.items():
+        tracemalloc.start()
+        built = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[f"{name}_bytes_per_annotation"] = size // max(1, count)
+        results[f"{name}_pickle_bytes"] = len(pickle.dumps(built))
+        del built
+    results["dict_json_bytes"] = len(json.dumps({n: [a.to_dict() for a in annots] for n, annots in document.items()}))
+    results["columnar_json_bytes"] = len(document.to_json())
+    try:
+        results["columnar_msgpack_bytes"] = len(document.to_msgpack())
+    except RuntimeError:
+        pass
+    return results
+
+
+def bench_dedupe(doc):
+    """Share of LLM generations the near-duplicate clustering skips, and what it costs."""
+    from extraction import get_annotations_from_pdf
+    from dedupe import plan_generations
+
+    annotations = get_annotations_from_pdf(doc).annotations()
+    start = time.perf_counter()
+    plan = plan_generations(annotations)
+    return dict(plan.stats(), seconds=round(time.perf_counter() - start, 4))
+
+
+def make_scanned_pdf(path, megabytes=500, width=1700, height=2200):
+    """
+    Write a scan-like PDF of roughly `megabytes` to `path`: one full-page
+    noise image per page, which compresses about as badly as real scans.
+    """
+    rng = np.random.default_rng(0)
+    doc = pymupdf.open()
+    page_bytes = None
+    while page_bytes is None or doc.page_count * page_bytes < megabytes * 1024 * 1024:
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        image = pymupdf.Pixmap(pymupdf.csRGB, width, height, pixels.tobytes(), False).tobytes("png")
+        page_bytes = len(image)
+        page = doc.new_page(width=612, height=792)
+        page.insert_image(page.rect, stream=image)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+INGEST_PROBE = """
+import io, resource, sys
+import pymupdf
+from PIL import Image
+from extraction import extract_annotations
+
+mode, path, workers = sys.argv[1], sys.argv[2], int(sys.argv[3])
+rss = lambda who: resource.getrusage(who).ru_maxrss
+with open(path, "rb") as f:
+    # The upload buffer Streamlit holds either way
+    upload = io.BytesIO(f.read())
+before = rss(resource.RUSAGE_SELF)
+if mode == "bytes":
+    source = upload.getvalue()
+    doc = pymupdf.open(stream=source, filetype="pdf")
+else:
+    from ingest import open_document, spill
+    _, source = spill(upload)
+    doc = open_document(source)
+doc[0].get_pixmap()
+extract_annotations(source, workers=workers)
+print(before, rss(resource.RUSAGE_SELF))
+"""
+
+
+def bench_ingest(megabytes=500, workers=2):
+    """
+    Peak RSS (MB) of opening a large scanned PDF from bytes, as before, vs
+    spilling it to a file and opening by path; each in a fresh process, with
+    extraction forced onto `workers` processes. `upload_mb` is the RSS with
+    just the in-memory upload both start from. Only the main process is
+    measured: ru_maxrss of spawned workers includes the parent they forked from.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_scanned_pdf(os.path.join(tmp, "scanned.pdf"), megabytes)
+        results["file_mb"] = round(os.path.getsize(path) / 2**20)
+        for mode in ("bytes", "path"):
+            env = dict(os.environ, NOTES_AI_MIN_PAGES_FOR_POOL="1", NOTES_AI_CACHE_DIR=os.path.join(tmp, mode))
+            out = subprocess.run([sys.executable, "-c", INGEST_PROBE, mode, path, str(workers)], cwd=here, env=env,
+                                 capture_output=True, text=True, check=True).stdout.split()
+            before, peak = (int(v) / 1024 for v in out)
+            results["upload_mb"] = round(before)
+            results[f"{mode}_peak_rss_mb"] = round(peak)
+    return results
+
+
+def _rss_kb():
+    """Current resident set size of this process, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return None
+
+
+def _release_free_memory():
+    # Hand memory freed by earlier runs back to the OS, so it isn't silently reused
+    gc.collect()
+    pymupdf.TOOLS.store_shrink(100)
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _peak_rss_growth(fn, interval=0.002):
+    """Run fn once, sampling RSS on a thread; returns (result, peak RSS above the starting RSS in KB)."""
+    _release_free_memory()
+    start = _rss_kb()
+    if start is None:
+        return fn(), None
+    peak = [start]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], _rss_kb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = fn()
+    finally:
+        done.set()
+        sampler.join()
+    return result, max(peak[0], _rss_kb()) - start
+
+
+def _measure(fn, repeat):
+    """
+    Best wall time over `repeat` untraced runs; one run with RSS sampled for
+    the peak growth in resident memory, which includes MuPDF, OpenCV and
+    other native allocations; and one run under tracemalloc for the peak
+    Python heap (tracing slows Python code down too much to time).
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    _, rss_growth = _peak_rss_growth(fn)
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {"seconds": round(best, 4), "peak_rss_growth_kb": rss_growth, "python_heap_peak_kb": peak // 1024}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(pages=100, highlights=8, ink=0, notes=2, ocr_pages=0, llm_latency=0.05, repeat=3):
+    """
+    Time each pipeline stage on a synthetic deck and the samples/ PDFs.
+    Returns a JSON-serialisable dict; stage entries carry seconds, peak RSS
+    growth and peak Python heap (see _measure). LLM calls go to a local
+    FakeHFServer.
+    """
+    from extraction import extract_annotations
+    from export import clear_export_cache, export_notes_md, export_notes_md_images, get_diagrams_zip, write_notes_bundle
+
+    decks = {f"synthetic-{pages}p": make_synthetic_pdf(pages, highlights, ink_per_page=ink, notes_per_page=notes)}
+    for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*.pdf"))):
+        with open(path, "rb") as f:
+            decks[os.path.basename(path)] = f.read()
+
+    stages = {}
+    extracted = {}
+    for name, data in decks.items():
+        annotations_by_slide, stats = _measure(lambda: extract_annotations(data, workers=1, incremental=False), repeat)
+        extracted[name] = annotations_by_slide
+        count = sum(len(v) for v in annotations_by_slide.values())
+        stages[f"{name}/extract"] = dict(stats, items=count)
+        # Re-upload of an unchanged deck: every page comes from the page store
+        extract_annotations(data, workers=1)
+        _, stats = _measure(lambda: extract_annotations(data, workers=1), repeat)
+        stages[f"{name}/extract_unchanged"] = dict(stats, items=count)
+
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            def highlights_only():
+                for page, annots in _highlights(doc):
+                    word_index = PageWordIndex(page)
+                    for a in annots:
+                        extract_highlighted_text(page, a, word_index)
+            _, stats = _measure(highlights_only, repeat)
+            stages[f"{name}/highlights"] = stats
+
+        ai_outputs = {a["key"]: {"el5": "e" * 400, "mnemonic": "m" * 40, "analogy": "a" * 400}
+                      for annots in annotations_by_slide.values() for a in annots}
+        images = {key: b"\x89PNG" + os.urandom(50_000) for key in list(ai_outputs)[:20]}
+        def export_md_cold():
+            clear_export_cache()
+            return export_notes_md(annotations_by_slide, ai_outputs)
+        _, stats = _measure(export_md_cold, repeat)
+        stages[f"{name}/export_md"] = stats
+        # One slide's outputs changed since the last export
+        first_key = next(iter(ai_outputs), None)
+        def export_md_incremental():
+            if first_key:
+                ai_outputs[first_key] = dict(ai_outputs[first_key], el5=os.urandom(8).hex())
+            return export_notes_md(annotations_by_slide, ai_outputs)
+        _, stats = _measure(export_md_incremental, repeat)
+        stages[f"{name}/export_md_incremental"] = stats
+        _, stats = _measure(lambda: export_notes_md_images(annotations_by_slide, ai_outputs, images), repeat)
+        stages[f"{name}/export_md_images"] = stats
+        _, stats = _measure(lambda: get_diagrams_zip(images), repeat)
+        stages[f"{name}/diagrams_zip"] = stats
+        _, stats = _measure(lambda: write_notes_bundle(io.BytesIO(), annotations_by_slide, ai_outputs, images), repeat)
+        stages[f"{name}/export_bundle"] = stats
+
+    if ocr_pages:
+        from ocr import iter_full_page_ocr, ocr_cache
+
+        with pymupdf.open(stream=make_synthetic_pdf(ocr_pages, highlights), filetype="pdf") as doc:
+            def full_page_ocr():
+                ocr_cache.clear()
+                return list(iter_full_page_ocr(doc))
+            _, stats = _measure(full_page_ocr, 1)
+            stages["ocr_fallback"] = dict(stats, items=ocr_pages)
+
+    import ai
+    from fake_hf import FakeHFServer
+    from hf_client import InferenceClient
+
+    os.environ.setdefault("HF_API_KEY", "bench")
+    synthetic = extracted[f"synthetic-{pages}p"]
+    annots = [a for page_number in list(synthetic)[:5] for a in synthetic[page_number]]
+    with FakeHFServer(latency=llm_latency) as server:
+        ai.set_client(InferenceClient(base_url=server.url))
+        for pack in (False, True):
+            def bulk():
+                ai.llm_cache.clear()
+                return list(ai.iter_creative_outputs(annots, max_concurrency=4, rate=1000, pack=pack))
+            _, stats = _measure(bulk, 1)
+            stages[f"llm_bulk_{'packed' if pack else 'single'}"] = dict(stats, items=len(annots))
+        ai.set_client(None)
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": {"pages": pages, "highlights": highlights, "ink": ink, "notes": notes,
+                   "ocr_pages": ocr_pages, "llm_latency": llm_latency, "repeat": repeat},
+        "stages": stages,
+    }
+
+
+def compare(results, baseline, threshold, min_seconds=0.005):
+    """
+    Stages whose time grew by more than `threshold` (a fraction) against
+    `baseline`. Stages faster than `min_seconds` in both runs are too noisy to judge.
+    """
+    regressions = []
+    for stage, stats in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before and max(before["seconds"], stats["seconds"]) >= min_seconds and before["seconds"] > 0 and stats["seconds"] > before["seconds"] * (1 + threshold):
+            regressions.append({"stage": stage, "before_s": before["seconds"], "after_s": stats["seconds"],
+                                "change": round(stats["seconds"] / before["seconds"] - 1, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="notes-ai benchmarks")
+    parser.add_argument("--pages", type=int, default=100, help="pages in the synthetic deck")
+    parser.add_argument("--highlights", type=int, default=8, help="highlights per synthetic page")
+    parser.add_argument("--ink", type=int, default=0, help="handwriting (type 9) annotations per synthetic page")
+    parser.add_argument("--notes", type=int, default=2, help="FreeText notes per synthetic page")
+    parser.add_argument("--ocr-pages", type=int, default=0, help="pages to run through the OCR fallback (needs EasyOCR)")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="fake HF server latency in seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline results JSON from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown per stage, e.g. 0.2 = 20%%")
+    parser.add_argument("--compare-highlights", action="store_true", help="also time the pre-index highlight extraction")
+    parser.add_argument("--ocr", action="store_true", help="also measure batched vs per-clip OCR")
+    parser.add_argument("--clips", action="store_true", help="also measure ink clip rendering and OCR calls avoided")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--startup", action="store_true", help="also measure OCR import time and memory")
+    parser.add_argument("--llm", action="store_true", help="also measure prompt packing against a fake HF server")
+    parser.add_argument("--ingest-mb", type=int, default=0,
+                        help="also measure peak RSS of bytes vs path ingestion on a scanned PDF of this size")
+    parser.add_argument("--dedupe", action="store_true", help="also measure LLM generations saved by clustering")
+    parser.add_argument("--memory", action="store_true", help="also measure memory per annotation, dict vs record")
+    args = parser.parse_args()
+
+    # Keep benchmarks away from the user's caches
+    os.environ.setdefault("NOTES_AI_CACHE_DIR", os.path.join(tempfile.mkdtemp(), "cache"))
+
+    if args.llm:
+        print("llm-packing", bench_llm_packing())
+
+    if args.startup:
+        print("startup", bench_startup())
+
+    if args.memory:
+        with pymupdf.open(stream=make_synthetic_pdf(args.pages, args.highlights, notes_per_page=args.notes),
+                          filetype="pdf") as doc:
+            print("annotation-memory", bench_annotation_memory(doc))
+
+    if args.ingest_mb:
+        print("ingest", bench_ingest(args.ingest_mb))
+
+    if args.dedupe:
+        for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*.pdf"))):
+            with pymupdf.open(path) as doc:
+                print("dedupe", os.path.basename(path), bench_dedupe(doc))
+        with pymupdf.open(stream=make_synthetic_pdf(args.pages, args.highlights, notes_per_page=args.notes),
+                          filetype="pdf") as doc:
+            print("dedupe", f"synthetic-{args.pages}p", bench_dedupe(doc))
+
+    if args.ocr:
+        with pymupdf.open(stream=make_synthetic_pdf(20, ink_per_page=4), filetype="pdf") as doc:
+            print("ocr-batch", bench_ocr_batch(doc, args.batch_size))
+
+    if args.clips:
+        print("clip-checks", check_clip_filter())
+        for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*.pdf"))):
+            with pymupdf.open(path) as doc:
+                print("clips", os.path.basename(path), bench_clip_filter(doc))
+        with pymupdf.open(stream=make_synthetic_pdf(args.pages, args.highlights, ink_per_page=max(args.ink, 4),
+                                                    notes_per_page=args.notes, marks_per_page=4),
+                          filetype="pdf") as doc:
+            print("clips", f"synthetic-{args.pages}p", bench_clip_filter(doc))
+
+    if args.compare_highlights:
+        for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*.pdf"))):
+            with pymupdf.open(path) as doc:
+                print(os.path.basename(path), bench_highlights(doc))
+        with pymupdf.open(stream=make_synthetic_pdf(args.pages), filetype="pdf") as doc:
+            print(f"synthetic-{args.pages}p", bench_highlights(doc))
+
+    results = run_suite(args.pages, args.highlights, args.ink, args.notes, args.ocr_pages,
+                        args.llm_latency, args.repeat)
+    for stage, stats in results["stages"].items():
+        rss = stats["peak_rss_growth_kb"]
+        print(f"{stage:45s} {stats['seconds']:>9.4f}s {'-' if rss is None else rss:>9} KB RSS "
+              f"{stats['python_heap_peak_kb']:>9d} KB heap")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['stage']}: {r['before_s']}s -> {r['after_s']}s (+{r['change']:.0%})")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
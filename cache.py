@@ -0,0 +1,145 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+import metrics
+
+CACHE_DIR = os.getenv("NOTES_AI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "notes-ai-cache"))
+
+
+class DiskCache:
+    """
+    Persistent key/value store backed by a single SQLite file.
+    Values are JSON-serialisable objects. Entries are evicted least recently
+    used first once the stored payload exceeds `max_bytes`, and expire after
+    `ttl` seconds when a ttl is given. Safe to share between threads and
+    processes.
+    """
+
+    def __init__(self, name, max_bytes=256 * 1024 * 1024, ttl=None, directory=None):
+        self.name = name
+        self.path = os.path.join(directory or CACHE_DIR, f"{name}.sqlite")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # `totals` keeps the payload size up to date through triggers, so
+            # eviction never has to SUM the whole table
+            conn.executescript("""
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,
+                    created REAL NOT NULL, accessed REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+                CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, bytes INTEGER NOT NULL);
+                INSERT OR IGNORE INTO totals SELECT 'cache', COALESCE(SUM(size), 0) FROM cache;
+                CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN
+                    UPDATE totals SET bytes = bytes + new.size WHERE name = 'cache'; END;
+                CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN
+                    UPDATE totals SET bytes = bytes - old.size WHERE name = 'cache'; END;
+                CREATE TRIGGER IF NOT EXISTS cache_update AFTER UPDATE OF size ON cache BEGIN
+                    UPDATE totals SET bytes = bytes - old.size + new.size WHERE name = 'cache'; END;
+                COMMIT;
+            """)
+            self._ready = True
+        return conn
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn:
+            row = conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                metrics.incr(f"cache.{self.name}.miss")
+                return default
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+        metrics.incr(f"cache.{self.name}.hit")
+        return json.loads(row[0])
+
+    def get_many(self, keys):
+        """{key: value} for the keys present, in one transaction."""
+        keys = list(keys)
+        now = time.time()
+        found = {}
+        with self._lock, closing(self._connect()) as conn:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                marks = ",".join("?" * len(batch))
+                for key, value, created in conn.execute(
+                        f"SELECT key, value, created FROM cache WHERE key IN ({marks})", batch):
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[key] = value
+                conn.executemany("UPDATE cache SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+            conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        metrics.incr(f"cache.{self.name}.hit", len(found))
+        metrics.incr(f"cache.{self.name}.miss", len(keys) - len(found))
+        return {key: json.loads(value) for key, value in found.items()}
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            payload = json.dumps(value)
+            rows.append((key, payload, len(payload), now, now))
+        with self._lock, closing(self._connect()) as conn:
+            # An upsert rather than INSERT OR REPLACE: REPLACE's implicit delete
+            # doesn't fire the trigger that keeps `totals` right
+            conn.executemany(
+                "INSERT INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                "created = excluded.created, accessed = excluded.accessed", rows
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT bytes FROM totals WHERE name = 'cache'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            stale.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        conn.executemany("DELETE FROM cache WHERE key = ?", stale)
+
+    def clear(self):
+        with self._lock, closing(self._connect()) as conn:
+            conn.execute("DELETE FROM cache")
+            conn.commit()
+
+    def stats(self):
+        with self._lock, closing(self._connect()) as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
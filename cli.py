@@ -0,0 +1,199 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ingest import file_hash, open_document
+
+LLM_MODES = ("hf", "stub", "off")
+
+
+def stub_outputs(annot):
+    """Deterministic stand-in for generate_creative_outputs, for offline runs."""
+    return {
+        "el5": f"[stub] {annot['text'][:80]}",
+        "mnemonic": "[stub mnemonic]",
+        "analogy": "[stub analogy]",
+        "diagram_prompt": "",
+    }
+
+
+def find_pdfs(paths):
+    pdfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            pdfs.extend(sorted(glob.glob(os.path.join(path, "**", "*.pdf"), recursive=True)))
+        else:
+            pdfs.append(path)
+    return pdfs
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(out_dir, manifest):
+    tmp = os.path.join(out_dir, "manifest.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(out_dir, "manifest.json"))
+
+
+def is_done(entry, llm, ocr):
+    """
+    Whether a manifest entry is complete (no failed generations), its outputs
+    exist and were made with the same --llm and OCR settings.
+    """
+    return (entry is not None and entry.get("complete") and entry.get("llm") == llm and entry.get("ocr") == ocr
+            and all(os.path.exists(p) for p in entry["outputs"]))
+
+
+def process_document(path, doc_hash, out_dir, llm="stub", ocr=True):
+    """Extract, optionally OCR and generate, then write <name>-<hash>.md/.json. Returns a summary."""
+    from extraction import extract_annotations
+    from export import export_notes_md
+
+    start = time.perf_counter()
+    # Documents already run in parallel, so each one is extracted serially
+    annotations_by_slide = extract_annotations(path, workers=1)
+    with open_document(path) as doc:
+        page_count = doc.page_count
+        source = "annotations"
+        if not annotations_by_slide and ocr:
+            from ocr import iter_full_page_ocr
+
+            source = "ocr"
+            for page_number, annotations, _, error in iter_full_page_ocr(doc):
+                if error is None:
+                    annotations_by_slide[page_number] = annotations
+            annotations_by_slide.dedupe_keys()
+
+    annotations = annotations_by_slide.annotations()
+    llm_calls_saved = llm_failed = 0
+    if llm == "hf":
+        from ai import is_cacheable, iter_creative_outputs
+        from dedupe import plan_generations
+
+        plan = plan_generations(annotations)
+        llm_calls_saved = plan.saved
+        ai_outputs = dict(iter_creative_outputs(annotations, plan=plan))
+        llm_failed = sum(1 for outputs in ai_outputs.values() if not is_cacheable(outputs))
+    elif llm == "stub":
+        ai_outputs = {a["key"]: stub_outputs(a) for a in annotations}
+    else:
+        ai_outputs = {}
+
+    stem = f"{os.path.splitext(os.path.basename(path))[0]}-{doc_hash[:8]}"
+    md_path = os.path.join(out_dir, f"{stem}.md")
+    json_path = os.path.join(out_dir, f"{stem}.json")
+    with open(md_path, "w", encoding="utf-8") as f:
+        f.write(export_notes_md(annotations_by_slide, ai_outputs))
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "source_file": path,
+            "sha256": doc_hash,
+            "pages": page_count,
+            "source": source,
+            # Columnar: see model.AnnotatedDocument.from_columns
+            "document": annotations_by_slide.to_columns(),
+            "ai_outputs": ai_outputs,
+        }, f, indent=2)
+
+    return {
+        "path": path,
+        "sha256": doc_hash,
+        "pages": page_count,
+        "annotations": len(annotations),
+        "source": source,
+        "llm_calls_saved": llm_calls_saved,
+        "llm_failed": llm_failed,
+        # Failed generations leave the document incomplete; the next run redoes it
+        "complete": llm_failed == 0,
+        # Settings the outputs were made with; a run with other settings redoes the document
+        "llm": llm,
+        "ocr": ocr,
+        "outputs": [md_path, json_path],
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def run(paths, out_dir, workers=2, llm="stub", ocr=True, force=False):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(out_dir)
+    start = time.perf_counter()
+
+    todo, skipped, seen = [], [], set()
+    for path in find_pdfs(paths):
+        doc_hash = file_hash(path)
+        done = manifest.get(doc_hash)
+        if doc_hash in seen or (not force and is_done(done, llm, ocr)):
+            skipped.append(path)
+        else:
+            todo.append((path, doc_hash))
+        seen.add(doc_hash)
+
+    processed, failed = [], []
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=ctx) as pool:
+        futures = {pool.submit(process_document, path, doc_hash, out_dir, llm, ocr): path
+                   for path, doc_hash in todo}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed.append({"path": futures[future], "error": str(e)})
+                print(f"FAILED {futures[future]}: {e}")
+                continue
+            processed.append(result)
+            manifest[result["sha256"]] = result
+            save_manifest(out_dir, manifest)
+            print(f"{result['path']}: {result['pages']} pages, {result['annotations']} annotations in {result['seconds']}s"
+                  + (f", {result['llm_failed']} generations failed" if result["llm_failed"] else ""))
+
+    elapsed = time.perf_counter() - start
+    pages = sum(r["pages"] for r in processed)
+    summary = {
+        "documents": len(processed),
+        "skipped": len(skipped),
+        "failed": failed,
+        "pages": pages,
+        "annotations": sum(r["annotations"] for r in processed),
+        "llm_calls_saved": sum(r.get("llm_calls_saved", 0) for r in processed),
+        "llm_failed": sum(r["llm_failed"] for r in processed),
+        "incomplete": [r["path"] for r in processed if not r["complete"]],
+        "elapsed_s": round(elapsed, 3),
+        "documents_per_s": round(len(processed) / elapsed, 3) if elapsed else None,
+        "pages_per_s": round(pages / elapsed, 3) if elapsed else None,
+        "llm": llm,
+        "workers": workers,
+    }
+    with open(os.path.join(out_dir, f"run-{time.strftime('%Y%m%d-%H%M%S')}.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process annotated lecture PDFs without the Streamlit UI.")
+    parser.add_argument("paths", nargs="+", help="PDF files or directories (searched recursively)")
+    parser.add_argument("-o", "--out", default="notes-ai-out", help="output directory")
+    parser.add_argument("-j", "--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="documents processed in parallel")
+    parser.add_argument("--llm", choices=LLM_MODES, default="stub",
+                        help="hf: call the Hugging Face API, stub: offline placeholders, off: no AI outputs")
+    parser.add_argument("--no-ocr", action="store_true", help="skip the full-page OCR fallback")
+    parser.add_argument("--force", action="store_true", help="re-process documents already in the manifest")
+    args = parser.parse_args(argv)
+
+    summary = run(args.paths, args.out, args.workers, args.llm, not args.no_ocr, args.force)
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
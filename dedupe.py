@@ -0,0 +1,147 @@
+import hashlib
+import os
+import re
+import unicodedata
+import numpy as np
+import metrics
+
+# Estimated Jaccard similarity of character shingles above which two
+# annotations count as the same thing
+DEDUPE_THRESHOLD = float(os.getenv("NOTES_AI_DEDUPE_THRESHOLD", "0.8"))
+SHINGLE_SIZE = 4
+NUM_PERM = 64
+BANDS = 16
+
+_PRIME = 4294967311  # smallest prime above 2**32
+_rng = np.random.default_rng(1)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)
+
+
+# Sentence punctuation, which doesn't change what an annotation says; dots and
+# commas inside numbers (3.14, 1,000) are kept, as are operators and symbols
+_PUNCTUATION = re.compile(r"(?<!\d)[.,]|[.,](?!\d)|[;:!?\"'`\u2018\u2019\u201c\u201d\u2026]")
+# Tokens that must match exactly for two texts to count as the same: "x > 0"
+# and "x < 0" or "O(n)" and "O(n^2)" differ in little else
+_MARKS = re.compile(r"[^\w\s]+|\d+")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+
+def marks(text):
+    """Symbols and numbers of a normalized text, in order."""
+    return _MARKS.findall(text)
+
+
+def shingles(text, k=SHINGLE_SIZE):
+    if len(text) <= k:
+        return {text}
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def minhash(shingle_set):
+    hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "little")
+                       for s in shingle_set], dtype=np.uint64)
+    # a * x + b stays below 2**64 because a, x < 2**32 + 15
+    return ((np.outer(_A, hashes) + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def cluster(texts, threshold=DEDUPE_THRESHOLD, bands=BANDS):
+    """
+    Group near-identical texts. Identical normalized texts always share a
+    group; otherwise MinHash LSH proposes candidate pairs and the exact
+    shingle Jaccard decides, for texts with the same symbols and numbers.
+    Returns a list of index lists, each in input order.
+    """
+    normalized = [normalize(t) for t in texts]
+    parent = list(range(len(texts)))
+    first_seen = {}
+    for i, text in enumerate(normalized):
+        if not text:
+            # Nothing left to compare (e.g. only punctuation); keep it on its own
+            continue
+        if text in first_seen:
+            parent[i] = first_seen[text]
+        else:
+            first_seen[text] = i
+
+    unique = list(first_seen.values())
+    sets = {i: shingles(normalized[i]) for i in unique}
+    text_marks = {i: marks(normalized[i]) for i in unique}
+    signatures = {i: minhash(sets[i]) for i in unique}
+    rows = NUM_PERM // bands
+    buckets = {}
+    for i, signature in signatures.items():
+        for band in range(bands):
+            buckets.setdefault((band, signature[band * rows:(band + 1) * rows].tobytes()), []).append(i)
+    checked = set()
+    for members in buckets.values():
+        for a_pos, a in enumerate(members):
+            for b in members[a_pos + 1:]:
+                if (a, b) in checked:
+                    continue
+                checked.add((a, b))
+                if text_marks[a] != text_marks[b]:
+                    continue
+                union = len(sets[a] | sets[b])
+                if union and len(sets[a] & sets[b]) / union >= threshold:
+                    parent[_find(parent, b)] = _find(parent, a)
+
+    groups = {}
+    for i in range(len(texts)):
+        groups.setdefault(_find(parent, i), []).append(i)
+    return list(groups.values())
+
+
+class GenerationPlan:
+    """
+    Which annotations to actually send to the LLM. `representatives` are
+    generated; `members[key]` lists every annotation key (the
+    representative's own included) that receives its outputs.
+    """
+
+    def __init__(self, representatives, members):
+        self.representatives = representatives
+        self.members = members
+
+    @property
+    def saved(self):
+        """Generations skipped because an equivalent annotation is generated instead."""
+        return sum(len(keys) - 1 for keys in self.members.values())
+
+    def stats(self):
+        return {
+            "annotations": sum(len(keys) for keys in self.members.values()),
+            "generations": len(self.representatives),
+            "saved": self.saved,
+        }
+
+
+def plan_generations(annotations, threshold=DEDUPE_THRESHOLD):
+    """
+    Cluster `annotations` by near-identical text. Each cluster is generated
+    once, for its highest-priority member (earliest on ties).
+    """
+    annotations = list(annotations)
+    with metrics.span("llm.dedupe", annotations=len(annotations)) as s:
+        groups = cluster([a["text"] for a in annotations], threshold)
+        representatives, members = [], {}
+        for group in groups:
+            best = max(group, key=lambda i: (annotations[i]["priority"], -i))
+            representatives.append(annotations[best])
+            members[annotations[best]["key"]] = [annotations[i]["key"] for i in group]
+        plan = GenerationPlan(representatives, members)
+        s.add(saved=plan.saved)
+    metrics.incr("llm.dedupe.saved", plan.saved)
+    return plan
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from cache import CACHE_DIR, DiskCache
+import metrics
+
+
+class ImageStore:
+    """
+    PNG files on disk named by the SHA-256 of their content, so identical
+    images are stored once. Files are evicted least recently read first once
+    the directory exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory=None, max_bytes=int(os.getenv("NOTES_AI_DIAGRAM_STORE_MB", "256")) * 1024 * 1024):
+        self.directory = directory or os.path.join(CACHE_DIR, "diagrams")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, f"{digest}.png")
+
+    def put(self, image_bytes):
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        path = self.path(digest)
+        with self._lock:
+            if not os.path.exists(path):
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(image_bytes)
+                os.replace(tmp, path)
+            os.utime(path)
+            self._evict()
+        return digest
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def get(self, digest):
+        try:
+            with open(self.path(digest), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(self.path(digest))
+        return data
+
+    def _evict(self):
+        # Other processes evict from the same directory, so any file may vanish mid-way
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".png"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class DiagramJobQueue:
+    """
+    Runs diagram generations in the background with at most `max_concurrency`
+    in flight. Jobs are identified by a hash of their prompt, so submitting
+    the same prompt twice (from any session) shares one job, and finished
+    prompts are remembered across restarts through `index`.
+
+    Job status is one of "queued", "running", "done" or "failed".
+    """
+
+    def __init__(self, store=None, max_concurrency=int(os.getenv("NOTES_AI_DIAGRAM_CONCURRENCY", "2")),
+                 generate=None):
+        if generate is None:
+            from ai import generate_diagram_image_sdxl as generate
+        self.store = store or ImageStore()
+        self.index = DiskCache("diagram_jobs", max_bytes=4 * 1024 * 1024)
+        self.generate = generate
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="diagram")
+
+    @staticmethod
+    def job_id(prompt):
+        return hashlib.sha256(" ".join(prompt.split()).lower().encode()).hexdigest()
+
+    def submit(self, prompt):
+        job_id = self.job_id(prompt)
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job and job["status"] != "failed":
+                return job_id
+            digest = self.index.get(job_id)
+            if digest and self.store.has(digest):
+                self.jobs[job_id] = {"status": "done", "prompt": prompt, "digest": digest, "error": None}
+                return job_id
+            self.jobs[job_id] = {"status": "queued", "prompt": prompt, "digest": None, "error": None,
+                                 "submitted": time.time()}
+        self._pool.submit(self._run, job_id, prompt)
+        return job_id
+
+    def _run(self, job_id, prompt):
+        self._update(job_id, status="running")
+        try:
+            result = self.generate(prompt)
+        except Exception as e:
+            result = {"error": str(e)}
+        if isinstance(result, bytes) and result:
+            digest = self.store.put(result)
+            self.index.set(job_id, digest)
+            self._update(job_id, status="done", digest=digest)
+            metrics.incr("diagrams.done")
+        else:
+            error = result.get("error") if isinstance(result, dict) else None
+            self._update(job_id, status="failed", error=error or "Failed to generate diagram.")
+            metrics.incr("diagrams.failed")
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+
+    def status(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else {"status": "unknown", "digest": None, "error": None}
+
+    def image_path(self, job_id):
+        """Path of the finished PNG, or None while the job is pending, failed or evicted."""
+        digest = self.status(job_id)["digest"]
+        return self.store.path(digest) if digest and self.store.has(digest) else None
+
+    def result(self, job_id):
+        digest = self.status(job_id)["digest"]
+        return self.store.get(digest) if digest else None
+
+
+class StoredImages(Mapping):
+    """
+    Read-only `{annotation key: PNG bytes}` view over a session's diagram
+    jobs. Only finished jobs appear, and bytes are read from the store when
+    accessed, so exporting does not hold every image in memory at once.
+    """
+
+    def __init__(self, queue, jobs):
+        self.queue = queue
+        self.jobs = jobs
+
+    def _done(self):
+        return [key for key, job_id in self.jobs.items() if self.queue.image_path(job_id)]
+
+    def __getitem__(self, key):
+        job_id = self.jobs.get(key)
+        data = self.queue.result(job_id) if job_id else None
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def __iter__(self):
+        return iter(self._done())
+
+    def __len__(self):
+        return len(self._done())
+
+    def __contains__(self, key):
+        job_id = self.jobs.get(key)
+        return bool(job_id and self.queue.image_path(job_id))
+
+    def image_id(self, key):
+        """Content hash of the image for `key`, or "" when there is none; reads nothing."""
+        job_id = self.jobs.get(key)
+        return (job_id and self.queue.image_path(job_id) and self.queue.status(job_id)["digest"]) or ""
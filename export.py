@@ -1,55 +1,211 @@
 import io
+import os
 import base64
+import hashlib
+import json
+import threading
 import zipfile
+from collections import OrderedDict
 import streamlit as st
+from cache import CACHE_DIR
+import metrics
 
-def export_notes_md(annotations_by_slide):
-    notes = []
-    for page_number in annotations_by_slide:
-        notes.append(f"# Slide {page_number}\n")
-        for annot in annotations_by_slide[page_number]:
-            key = annot["key"]
-            notes.append(f"**{annot['type']}**: {annot['text']}\n")
-            if f"accepted_{key}" in st.session_state:
-                ai = st.session_state[f"accepted_{key}"]
-            elif f"ai_{key}" in st.session_state:
-                ai = st.session_state[f"ai_{key}"]
-            else:
-                ai = {}
-            notes.append(f"- **ELI5:** {ai.get('el5','')}")
-            notes.append(f"- **Mnemonic:** {ai.get('mnemonic','')}")
-            notes.append(f"- **Analogy:** {ai.get('analogy','')}")
-            notes.append("\n")
-    return "\n".join(notes)
+EXPORT_DIR = os.path.join(CACHE_DIR, "exports")
+EXPORTS_KEPT = int(os.getenv("NOTES_AI_EXPORTS_KEPT", "8"))
+CHUNK_CACHE_SIZE = 4096
+# format: (download file name, mime type, how diagrams appear in the Markdown)
+EXPORT_FORMATS = {
+    "md": ("study_notes.md", "text/markdown", "none"),
+    "md_images": ("study_notes_with_diagrams.md", "text/markdown", "inline"),
+    "bundle": ("study_notes.zip", "application/zip", "file"),
+    "diagrams": ("diagrams.zip", "application/zip", "none"),
+}
+
+_chunks = OrderedDict()
+_chunks_lock = threading.Lock()
+
+def _ai_for(key, ai_outputs=None):
+    """AI outputs for `key`: from `ai_outputs` when given, else the Streamlit session."""
+    if ai_outputs is not None:
+        return ai_outputs.get(key) or {}
+    if f"accepted_{key}" in st.session_state:
+        return st.session_state[f"accepted_{key}"]
+    elif f"ai_{key}" in st.session_state:
+        return st.session_state[f"ai_{key}"]
+    return {}
+
+def _image_id(images, key):
+    # Identifies an image without reading it when the mapping can (StoredImages)
+    if hasattr(images, "image_id"):
+        return images.image_id(key)
+    data = images.get(key)
+    return hashlib.sha256(data).hexdigest() if data else ""
+
+def image_name(key):
+    return f"diagrams/diagram_{key}.png"
 
-def export_notes_md_images(annotations_by_slide):
-    notes = []
-    for page_number in annotations_by_slide:
-        notes.append(f"# Slide {page_number}\n")
-        for annot in annotations_by_slide[page_number]:
-            key = annot["key"]
-            notes.append(f"**{annot['type']}**: {annot['text']}\n")
-            if f"accepted_{key}" in st.session_state:
-                ai = st.session_state[f"accepted_{key}"]
-            elif f"ai_{key}" in st.session_state:
-                ai = st.session_state[f"ai_{key}"]
-            else:
-                ai = {}
-            notes.append(f"- **ELI5:** {ai.get('el5','')}")
-            notes.append(f"- **Mnemonic:** {ai.get('mnemonic','')}")
-            notes.append(f"- **Analogy:** {ai.get('analogy','')}")
-            img_bytes = st.session_state["diagram_images"].get(key)
+def slide_fingerprint(page_number, annots, ai_outputs=None, images=None, image_mode="none"):
+    """Hash of everything that ends up in a slide's Markdown."""
+    digest = hashlib.sha256(f"{page_number}|{image_mode}".encode())
+    for annot in annots:
+        key = annot["key"]
+        ai = _ai_for(key, ai_outputs)
+        digest.update(json.dumps([key, annot["type"], annot["text"],
+                                  ai.get("el5", ""), ai.get("mnemonic", ""), ai.get("analogy", "")]).encode())
+        if image_mode != "none":
+            digest.update(_image_id(images, key).encode())
+    return digest.hexdigest()
+
+def _render_slide(page_number, annots, ai_outputs, images, image_mode):
+    notes = [f"# Slide {page_number}\n"]
+    for annot in annots:
+        key = annot["key"]
+        notes.append(f"**{annot['type']}**: {annot['text']}\n")
+        ai = _ai_for(key, ai_outputs)
+        notes.append(f"- **ELI5:** {ai.get('el5','')}")
+        notes.append(f"- **Mnemonic:** {ai.get('mnemonic','')}")
+        notes.append(f"- **Analogy:** {ai.get('analogy','')}")
+        if image_mode == "inline":
+            img_bytes = images.get(key)
             if img_bytes:
                 b64img = base64.b64encode(img_bytes).decode()
                 notes.append(f"![diagram_{key}](data:image/png;base64,{b64img})")
-            notes.append("\n")
+        elif image_mode == "file" and key in images:
+            notes.append(f"![diagram_{key}]({image_name(key)})")
+        notes.append("\n")
     return "\n".join(notes)
 
+def _slide_chunk(page_number, annots, ai_outputs, images, image_mode):
+    # Inlined images would make the cache as large as the exports themselves
+    if image_mode == "inline":
+        return _render_slide(page_number, annots, ai_outputs, images, image_mode)
+    fingerprint = slide_fingerprint(page_number, annots, ai_outputs, images, image_mode)
+    with _chunks_lock:
+        chunk = _chunks.get(fingerprint)
+        if chunk is not None:
+            _chunks.move_to_end(fingerprint)
+    if chunk is not None:
+        metrics.incr("export.chunk.hit")
+        return chunk
+    metrics.incr("export.chunk.miss")
+    chunk = _render_slide(page_number, annots, ai_outputs, images, image_mode)
+    with _chunks_lock:
+        _chunks[fingerprint] = chunk
+        while len(_chunks) > CHUNK_CACHE_SIZE:
+            _chunks.popitem(last=False)
+    return chunk
+
+def clear_export_cache():
+    with _chunks_lock:
+        _chunks.clear()
+
+def iter_notes_md(annotations_by_slide, ai_outputs=None, images=None, image_mode="none"):
+    """
+    Yield the study guide one slide at a time. Slides whose annotations and
+    AI outputs are unchanged come from a cache instead of being rebuilt.
+    `image_mode` is "none", "inline" (base64) or "file" (diagrams/ links).
+    """
+    images = images if images is not None else {}
+    for i, page_number in enumerate(annotations_by_slide):
+        if i:
+            yield "\n"
+        yield _slide_chunk(page_number, annotations_by_slide[page_number], ai_outputs, images, image_mode)
+
+def export_notes_md(annotations_by_slide, ai_outputs=None):
+    with metrics.span("export.md"):
+        return "".join(iter_notes_md(annotations_by_slide, ai_outputs))
+
+def export_notes_md_images(annotations_by_slide, ai_outputs=None, diagram_images=None):
+    with metrics.span("export.md_images"):
+        return "".join(iter_notes_md(annotations_by_slide, ai_outputs, diagram_images, "inline"))
+
+def _write_images(zf, diagram_images, keys, prefix=""):
+    # PNGs are already compressed; store them as-is, one at a time
+    written = 0
+    for key in keys:
+        img_bytes = diagram_images.get(key)
+        if img_bytes:
+            zf.writestr(f"{prefix}diagram_{key}.png", img_bytes, compress_type=zipfile.ZIP_STORED)
+            written += 1
+    return written
+
+def write_diagrams_zip(fileobj, diagram_images):
+    with metrics.span("export.zip") as s, zipfile.ZipFile(fileobj, "w") as zf:
+        s.add(images=_write_images(zf, diagram_images, list(diagram_images)))
+
 def get_diagrams_zip(diagram_images_dict):
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w") as zf:
-        for key, img_bytes in diagram_images_dict.items():
-            if img_bytes:
-                zf.writestr(f"diagram_{key}.png", img_bytes)
+    write_diagrams_zip(zip_buffer, diagram_images_dict)
     zip_buffer.seek(0)
     return zip_buffer
+
+def write_notes_bundle(fileobj, annotations_by_slide, ai_outputs=None, diagram_images=None):
+    """
+    ZIP with study_notes.md linking to diagrams/diagram_<key>.png files, so
+    no image is base64-encoded or held in memory with the others.
+    """
+    diagram_images = diagram_images if diagram_images is not None else {}
+    keys = [a["key"] for annots in annotations_by_slide.values() for a in annots]
+    with metrics.span("export.bundle") as s, zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zf:
+        with zf.open("study_notes.md", "w") as f:
+            for chunk in iter_notes_md(annotations_by_slide, ai_outputs, diagram_images, "file"):
+                f.write(chunk.encode("utf-8"))
+        s.add(images=_write_images(zf, diagram_images, keys, prefix="diagrams/"))
+
+def export_fingerprint(fmt, annotations_by_slide, ai_outputs=None, diagram_images=None):
+    diagram_images = diagram_images if diagram_images is not None else {}
+    image_mode = EXPORT_FORMATS[fmt][2]
+    digest = hashlib.sha256(fmt.encode())
+    if fmt == "diagrams":
+        for key in diagram_images:
+            digest.update(f"{key}={_image_id(diagram_images, key)}".encode())
+    else:
+        for page_number, annots in annotations_by_slide.items():
+            digest.update(slide_fingerprint(page_number, annots, ai_outputs, diagram_images, image_mode).encode())
+    return digest.hexdigest()
+
+def export_path(fmt, fingerprint):
+    return os.path.join(EXPORT_DIR, f"{fingerprint}{os.path.splitext(EXPORT_FORMATS[fmt][0])[1]}")
+
+def prepare_export(fmt, annotations_by_slide, ai_outputs=None, diagram_images=None):
+    """
+    Write export `fmt` to a file under EXPORT_DIR named by a fingerprint of
+    its inputs and return the path. Unchanged notes reuse the existing file;
+    only the most recent EXPORTS_KEPT files are kept.
+    """
+    path = export_path(fmt, export_fingerprint(fmt, annotations_by_slide, ai_outputs, diagram_images))
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    if fmt in ("md", "md_images"):
+        with open(tmp, "w", encoding="utf-8") as f, metrics.span(f"export.{fmt}"):
+            for chunk in iter_notes_md(annotations_by_slide, ai_outputs, diagram_images, EXPORT_FORMATS[fmt][2]):
+                f.write(chunk)
+    elif fmt == "bundle":
+        with open(tmp, "w+b") as f:
+            write_notes_bundle(f, annotations_by_slide, ai_outputs, diagram_images)
+    else:
+        with open(tmp, "w+b") as f:
+            write_diagrams_zip(f, diagram_images)
+    os.replace(tmp, path)
+    _prune_exports()
+    return path
+
+def _prune_exports():
+    # Other sessions prune the same directory, so any file may vanish mid-way
+    files = []
+    for name in os.listdir(EXPORT_DIR):
+        if not name.endswith(".tmp"):
+            path = os.path.join(EXPORT_DIR, name)
+            try:
+                files.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                continue
+    files.sort(reverse=True)
+    for _, path in files[EXPORTS_KEPT:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,254 @@
+import multiprocessing
+import os
+import sys
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import metrics
+from cache import DiskCache
+from ingest import open_document, release_page_cache
+from model import Annotation, AnnotatedDocument
+from ocr import extract_handwritten_text_batch, handwriting_settings, ocr_failed, render_clip, OCR_BATCH_SIZE
+from utils import annotation_key, extract_highlighted_text, page_fingerprint, PageWordIndex
+
+# Below this many pages the pool start-up costs more than it saves
+MIN_PAGES_FOR_POOL = int(os.getenv("NOTES_AI_MIN_PAGES_FOR_POOL", "16"))
+TASKS_PER_WORKER = 4
+# Bump when the stored per-page results change shape or meaning
+EXTRACTION_VERSION = 2
+
+# Finished per-page results by page fingerprint, so re-uploads and revised
+# decks only process new or changed pages
+page_store = DiskCache("pages", max_bytes=int(os.getenv("NOTES_AI_PAGE_CACHE_MB", "64")) * 1024 * 1024)
+
+
+def default_workers():
+    return int(os.getenv("NOTES_AI_WORKERS", "0")) or os.cpu_count() or 1
+
+
+def _annotation_data(page_number, annot_label, content, page_texts, key):
+    return Annotation(page_number, annot_label, content, key, 2 if "?" in content else 1, page_texts)
+
+
+def extract_page_annotations(page, page_number, clips, page_texts=None, fingerprint=None):
+    """
+    Extract the annotations of one page. Handwritten annotations are returned
+    with empty text and their rendered clip is queued on `clips` as
+    (annotation_data, pixmap) for the document-wide OCR stage; clips that
+    can't hold text (ocr.render_clip) are dropped here. The slide
+    text goes into `page_texts` once and is shared by the page's records.
+    Keys come from `fingerprint` (utils.page_fingerprint), computed if not given.
+    """
+    annotations = []
+    page_texts = page_texts if page_texts is not None else {}
+    content_fingerprint, _, annot_fingerprints = fingerprint or page_fingerprint(page)
+    seen = {}
+    page_texts[page_number] = page.get_text().strip().replace('\n', ' ')
+    word_index = None
+    annot = page.first_annot
+    while annot:
+        annot_type = annot.type[0]
+        content = annot.info.get("content", "")
+        annot_label = None
+        key = annotation_key(content_fingerprint, annot_fingerprints[annot.xref], seen)
+
+        if annot_type == 1:
+            annot_label = "Sticky Note"
+        elif annot_type == 2:
+            annot_label = "FreeText"
+        elif annot_type == 8:
+            if word_index is None:
+                word_index = PageWordIndex(page)
+            content = extract_highlighted_text(page, annot, word_index)
+            annot_label = "Highlight"
+        elif annot_type == 9:
+            clip, rejected = render_clip(page, annot.rect)
+            if rejected:
+                metrics.incr(f"ocr.clips.skipped.{rejected}")
+            else:
+                annotation_data = _annotation_data(page_number, "Handwritten", "", page_texts, key)
+                clips.append((annotation_data, clip))
+                annotations.append(annotation_data)
+        else:
+            annot_label = None
+
+        if annot_label and content:
+            annotations.append(_annotation_data(page_number, annot_label, content, page_texts, key))
+        annot = annot.next
+    if not annotations:
+        del page_texts[page_number]
+    return annotations
+
+
+def resolve_handwriting(annotations_by_slide, clips, batch_size=OCR_BATCH_SIZE):
+    """OCR all queued clips in batches, fill in their text and drop empty results."""
+    if not clips:
+        return annotations_by_slide
+    metrics.incr("ocr.clips.sent", len(clips))
+    with metrics.span("ocr.handwriting", clips=len(clips)):
+        texts = extract_handwritten_text_batch([clip for _, clip in clips], batch_size)
+    for (annotation, _), text in zip(clips, texts):
+        annotation.text = text
+        annotation.priority = 2 if "?" in text else 1
+    for page_number in list(annotations_by_slide):
+        annotations = [a for a in annotations_by_slide[page_number] if a["text"]]
+        if annotations:
+            annotations_by_slide[page_number] = annotations
+        else:
+            del annotations_by_slide[page_number]
+    return annotations_by_slide.prune()
+
+
+def get_annotations_from_pdf(doc, pages=None, batch_size=OCR_BATCH_SIZE, fingerprints=None):
+    """
+    Serial extraction over `pages` (0-based indices, default: all pages).
+    Returns an AnnotatedDocument, {page_number: [Annotation, ...]} with
+    1-based page numbers. `fingerprints` maps page index to a precomputed
+    utils.page_fingerprint.
+    """
+    annotations_by_slide = AnnotatedDocument()
+    fingerprints = fingerprints or {}
+    clips = []
+    with metrics.span("extract.pages") as s:
+        for index in (range(doc.page_count) if pages is None else pages):
+            annotations = extract_page_annotations(doc[index], index + 1, clips, annotations_by_slide.page_texts,
+                                                   fingerprints.get(index))
+            if annotations:
+                annotations_by_slide[index + 1] = annotations
+            s.add(pages=1)
+    release_page_cache()
+    return resolve_handwriting(annotations_by_slide, clips, batch_size)
+
+
+def page_ranges(pages, workers, pages_per_task=None):
+    """Split a page count, or a list of 0-based page indices, into tasks."""
+    pages = range(pages) if isinstance(pages, int) else list(pages)
+    if not pages_per_task:
+        pages_per_task = max(1, -(-len(pages) // (workers * TASKS_PER_WORKER)))
+    return [pages[start:start + pages_per_task] for start in range(0, len(pages), pages_per_task)]
+
+
+def _store_key(fingerprint, settings):
+    # Stored pages hold handwriting OCR text, so OCR settings are part of the key
+    return f"{EXTRACTION_VERSION}:{settings}:{fingerprint}"
+
+
+def _stored_page(page_number, value, page_texts):
+    if not value["annotations"]:
+        return []
+    page_texts[page_number] = value["text"]
+    return [Annotation(page_number, typ, text, key, priority, page_texts)
+            for typ, text, key, priority in value["annotations"]]
+
+
+def _page_value(annotations):
+    return {
+        "text": annotations[0].context if annotations else "",
+        "annotations": [[a.type, a.text, a.key, a.priority] for a in annotations],
+    }
+
+
+_worker_doc = None
+_worker_batch_size = OCR_BATCH_SIZE
+
+
+def _init_worker(source, batch_size):
+    global _worker_doc, _worker_batch_size
+    _worker_doc = open_document(source)
+    _worker_batch_size = batch_size
+
+
+def _extract_range(pages):
+    return get_annotations_from_pdf(_worker_doc, pages, _worker_batch_size)
+
+
+def extract_annotations(source, workers=None, pages_per_task=None, batch_size=OCR_BATCH_SIZE, incremental=True):
+    """
+    Extract annotations from a PDF given as a path (see ingest.spill) or as
+    bytes, splitting the document into page ranges processed by a pool of
+    worker processes. Each worker opens the document itself (by path, so the
+    file is never copied into it) and OCRs the handwriting of its page range in
+    batches of `batch_size`. The result is identical to a serial
+    `get_annotations_from_pdf` pass, including key and page order.
+
+    With `incremental`, pages whose fingerprint is in `page_store` are taken
+    from it and only new or changed pages are extracted (and then stored).
+    """
+    workers = workers or default_workers()
+    with metrics.span("extract.document") as s:
+        with open_document(source) as doc:
+            page_count = doc.page_count
+            s.add(pages=page_count)
+            fingerprints, stored = {}, {}
+            settings = handwriting_settings(batch_size)
+            if incremental:
+                with metrics.span("extract.fingerprint", pages=page_count):
+                    fingerprints = {index: page_fingerprint(doc[index]) for index in range(page_count)}
+                values = page_store.get_many(_store_key(fp, settings) for _, fp, _ in fingerprints.values())
+                for index, (_, fingerprint, _) in fingerprints.items():
+                    if _store_key(fingerprint, settings) in values:
+                        stored[index] = values[_store_key(fingerprint, settings)]
+            changed = [index for index in range(page_count) if index not in stored]
+            s.add(changed_pages=len(changed))
+            if workers <= 1 or len(changed) < max(1, MIN_PAGES_FOR_POOL):
+                fresh = get_annotations_from_pdf(doc, changed, batch_size, fingerprints)
+            else:
+                fresh = None
+        if fresh is None:
+            # Stages inside worker processes are not recorded; this span covers them
+            fresh = _extract_parallel(source, changed, workers, pages_per_task, batch_size)
+        if not incremental:
+            return fresh.dedupe_keys()
+
+    annotations_by_slide = AnnotatedDocument()
+    new_values = {}
+    for index in range(page_count):
+        page_number = index + 1
+        if index in stored:
+            annotations = _stored_page(page_number, stored[index], annotations_by_slide.page_texts)
+        else:
+            annotations = fresh.get(page_number, [])
+            # Like failed LLM responses, failed OCR is retried next time rather than stored
+            if not any(a.type == "Handwritten" and ocr_failed(a.text) for a in annotations):
+                new_values[_store_key(fingerprints[index][1], settings)] = _page_value(annotations)
+        if annotations:
+            annotations_by_slide.merge({page_number: annotations})
+    if new_values:
+        page_store.set_many(new_values)
+    return annotations_by_slide.dedupe_keys()
+
+
+_main_lock = threading.Lock()
+
+
+@contextmanager
+def _without_main_script():
+    """
+    Spawned workers re-run the parent's __main__ script as __mp_main__.
+    Under Streamlit that is app.py, whose module-level code (metrics server,
+    OCR prewarm, the UI itself) must not run in every worker, so the
+    workers are started while __main__ is an empty module.
+    """
+    with _main_lock:
+        main = sys.modules.get("__main__")
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main
+
+
+def _extract_parallel(source, pages, workers, pages_per_task, batch_size):
+    ranges = page_ranges(pages, workers, pages_per_task)
+    annotations_by_slide = AnnotatedDocument()
+    # spawn rather than fork: torch (pulled in by EasyOCR) is not fork-safe
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges)), mp_context=ctx,
+                             initializer=_init_worker, initargs=(source, batch_size)) as pool:
+        # map() submits every range up front, which starts all the workers
+        with _without_main_script():
+            chunks = pool.map(_extract_range, ranges)
+        for chunk in chunks:
+            annotations_by_slide.merge(chunk)
+    return annotations_by_slide
@@ -0,0 +1,123 @@
+import argparse
+import io
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+STUDY_AIDS = {
+    "el5": "A simple explanation.",
+    "mnemonic": "Simple Memorable Phrase",
+    "analogy": "It is like making tea.",
+    "diagram_prompt": "A labelled diagram of the concept",
+}
+
+
+def _png():
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 220, 255)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeHFServer:
+    """
+    Local stand-in for the Hugging Face Inference API, for offline runs and
+    benchmarks. Text models echo the prompt followed by a JSON answer, image
+    models return a small PNG. `latency` is added to every request and
+    `statuses` is an optional list of status codes to return (in order)
+    before answering normally, e.g. [503, 429].
+
+        with FakeHFServer(latency=0.2) as server:
+            client = InferenceClient(base_url=server.url)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, statuses=None):
+        self.latency = latency
+        self.statuses = list(statuses or [])
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._png = _png()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _next_status(self):
+        with self._lock:
+            self.requests += 1
+            return self.statuses.pop(0) if self.statuses else 200
+
+    def answer(self, prompt):
+        if "JSON array" in prompt:
+            count = sum(1 for line in prompt.splitlines() if re.match(r"\d+\. \(", line))
+            return json.dumps([{"id": i, **STUDY_AIDS} for i in range(1, count + 1)])
+        return json.dumps(STUDY_AIDS)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                with server._lock:
+                    server.bytes_received += len(body)
+                time.sleep(server.latency)
+                status = server._next_status()
+                if status != 200:
+                    self._send(status, "application/json", json.dumps({"error": "busy", "estimated_time": 0.01}).encode())
+                elif "diffusion" in self.path:
+                    self._send(200, "image/png", server._png)
+                else:
+                    payload = json.loads(body or b"{}")
+                    prompt = payload.get("inputs", "")
+                    answer = server.answer(prompt)
+                    if payload.get("parameters", {}).get("return_full_text", True):
+                        answer = f"{prompt}\n{answer}"
+                    text = json.dumps([{"generated_text": answer}])
+                    self._send(200, "application/json", text.encode())
+
+            def _send(self, status, content_type, data):
+                self.send_response(status)
+                self.send_header("content-type", content_type)
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Hugging Face Inference API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeHFServer(port=args.port, latency=args.latency)
+    print(f"Serving on {server.url} (set HF_API_BASE to use it)")
+    server.httpd.serve_forever()
@@ -0,0 +1,85 @@
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+HF_API_BASE = "https://api-inference.huggingface.co"
+RETRYABLE_STATUS = (429, 503)
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class InferenceClient:
+    """
+    Shared HTTP client for the Hugging Face Inference API. One keep-alive
+    session (and connection pool) is reused by every call, 429/503 responses
+    are retried with jittered exponential backoff, and the latency of every
+    request is recorded per model. `base_url` can point at a local stand-in
+    server (see fake_hf.py).
+    """
+
+    def __init__(self, base_url=None, pool_size=10, max_retries=3, backoff=1.0, max_backoff=30.0,
+                 timeouts=None):
+        self.base_url = (base_url or os.getenv("HF_API_BASE") or HF_API_BASE).rstrip("/")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeouts = timeouts or {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.latencies = defaultdict(lambda: deque(maxlen=1000))
+        self._lock = threading.Lock()
+
+    def post(self, model, payload, headers=None, timeout=None):
+        url = f"{self.base_url}/models/{model}"
+        timeout = timeout or self.timeouts.get(model, DEFAULT_TIMEOUT)
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            with metrics.span("hf.request", requests=1):
+                response = self.session.post(url, headers=headers, json=payload, timeout=timeout)
+            self._record(model, time.perf_counter() - start)
+            if response.status_code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                return response
+            metrics.incr(f"hf.retry.{response.status_code}")
+            time.sleep(self._retry_delay(attempt, response))
+        return response
+
+    def _retry_delay(self, attempt, response):
+        retry_after = response.headers.get("retry-after", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        if response.status_code == 503:
+            # HF reports how long the model still needs to load
+            try:
+                estimated = float(response.json().get("estimated_time", 0))
+            except (ValueError, AttributeError):
+                estimated = 0
+            if estimated:
+                return min(estimated, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _record(self, model, seconds):
+        with self._lock:
+            self.latencies[model].append(seconds)
+
+    def latency_stats(self):
+        with self._lock:
+            samples = {model: sorted(values) for model, values in self.latencies.items()}
+        stats = {}
+        for model, values in samples.items():
+            if not values:
+                continue
+            stats[model] = {
+                "count": len(values),
+                "mean_s": sum(values) / len(values),
+                "p50_s": values[len(values) // 2],
+                "p95_s": values[min(len(values) - 1, int(len(values) * 0.95))],
+                "max_s": values[-1],
+            }
+        return stats
@@ -0,0 +1,131 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+import pymupdf
+from cache import CACHE_DIR
+
+UPLOAD_DIR = os.path.join(CACHE_DIR, "uploads")
+MAX_DOCUMENT_BYTES = int(os.getenv("NOTES_AI_MAX_DOCUMENT_MB", "1024")) * 1024 * 1024
+MAX_PAGES = int(os.getenv("NOTES_AI_MAX_PAGES", "2000"))
+UPLOAD_BUDGET_BYTES = int(os.getenv("NOTES_AI_UPLOAD_CACHE_MB", "2048")) * 1024 * 1024
+# Uploads used this recently may still be open in a session, prefetch thread or worker
+UPLOAD_GRACE_SECONDS = int(os.getenv("NOTES_AI_UPLOAD_GRACE_S", "3600"))
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# PyMuPDF is not thread-safe, even across separate documents. In the app,
+# where prefetch threads render in the background, every MuPDF call holds
+# this lock: renders, the OCR render stage, cache shrinking and the script
+# thread's own opening and extraction.
+MUPDF_LOCK = threading.RLock()
+
+
+class DocumentTooLarge(ValueError):
+    pass
+
+
+def file_hash(path):
+    """SHA-256 of a file, read through a memory map instead of into the heap."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, len(mapped), CHUNK_SIZE):
+                digest.update(mapped[start:start + CHUNK_SIZE])
+    return digest.hexdigest()
+
+
+def check_size(size, max_bytes=MAX_DOCUMENT_BYTES):
+    if size > max_bytes:
+        raise DocumentTooLarge(f"Document is {size / 2**20:.1f} MB; the limit is {max_bytes / 2**20:.1f} MB "
+                               "(NOTES_AI_MAX_DOCUMENT_MB).")
+
+
+def spill(fileobj, max_bytes=MAX_DOCUMENT_BYTES):
+    """
+    Copy an upload to UPLOAD_DIR in CHUNK_SIZE pieces, hashing as it goes, and
+    return (sha256, path) of the content-addressed file. Nothing larger than
+    one chunk is held in memory; an identical earlier upload is reused.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    tmp = os.path.join(UPLOAD_DIR, f".{os.getpid()}-{threading.get_ident()}.tmp")
+    fileobj.seek(0)
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+                size += len(chunk)
+                check_size(size, max_bytes)
+                digest.update(chunk)
+                f.write(chunk)
+        doc_hash = digest.hexdigest()
+        path = os.path.join(UPLOAD_DIR, f"{doc_hash}.pdf")
+        if os.path.exists(path):
+            os.remove(tmp)
+            os.utime(path)
+        else:
+            os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    _prune(keep=path)
+    return doc_hash, path
+
+
+def _prune(keep):
+    # Other processes prune the same directory, so any file may vanish mid-way
+    files = []
+    for name in os.listdir(UPLOAD_DIR):
+        if name.endswith(".pdf"):
+            path = os.path.join(UPLOAD_DIR, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort(reverse=True)
+    recent = time.time() - UPLOAD_GRACE_SECONDS
+    total = 0
+    for mtime, size, path in files:
+        total += size
+        if total > UPLOAD_BUDGET_BYTES and path != keep and mtime < recent:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def touch(path):
+    """Mark an upload as in use, so _prune leaves it alone for UPLOAD_GRACE_SECONDS."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_document(source, max_pages=MAX_PAGES, max_bytes=MAX_DOCUMENT_BYTES):
+    """
+    Open a PDF given as a path (read by MuPDF on demand, pages loaded only
+    when accessed) or as bytes, enforcing the document byte and page limits.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        check_size(len(source), max_bytes)
+        doc = pymupdf.open(stream=source, filetype="pdf")
+    else:
+        check_size(os.path.getsize(source), max_bytes)
+        doc = pymupdf.open(source, filetype="pdf")
+    page_count = doc.page_count
+    if page_count > max_pages:
+        doc.close()
+        raise DocumentTooLarge(f"Document has {page_count} pages; the limit is {max_pages} (NOTES_AI_MAX_PAGES).")
+    return doc
+
+
+def release_page_cache():
+    """Drop MuPDF's cache of decoded images and fonts, e.g. after a run of scanned pages."""
+    with MUPDF_LOCK:
+        pymupdf.TOOLS.store_shrink(100)
@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Switched on for the whole process (env or enable()), as opposed to held by some of its users
+_forced = os.getenv("NOTES_AI_METRICS") == "1"
+# owner -> time its hold lapses; a session that goes away without releasing stops counting
+_holders = {}
+_holders_lock = threading.Lock()
+_held_until = 0.0
+HOLD_SECONDS = float(os.getenv("NOTES_AI_METRICS_HOLD_S", "900"))
+LOG_PATH = os.getenv("NOTES_AI_METRICS_LOG")
+
+
+class Registry:
+    """
+    Process-wide store of stage timings and event counters. Every finished
+    span is aggregated per stage name and kept in a bounded log so that a
+    breakdown can be taken for any window (e.g. one upload) via mark().
+    """
+
+    def __init__(self, log_size=10000):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.log = deque(maxlen=log_size)
+        self.stages = defaultdict(lambda: {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "items": defaultdict(float)})
+        self.counters = defaultdict(float)
+
+    def record(self, name, seconds, counts):
+        with self._lock:
+            self._seq += 1
+            self.log.append((self._seq, name, seconds, counts))
+            stage = self.stages[name]
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+            for item, n in counts.items():
+                stage["items"][item] += n
+        if LOG_PATH:
+            with open(LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"ts": time.time(), "stage": name, "seconds": seconds, **counts}) + "\n")
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def mark(self):
+        with self._lock:
+            return self._seq
+
+    def breakdown(self, since=0):
+        """Per-stage totals of the spans recorded after mark `since`, slowest first."""
+        totals = {}
+        with self._lock:
+            entries = [e for e in self.log if e[0] > since]
+        for _, name, seconds, counts in entries:
+            row = totals.setdefault(name, {"stage": name, "count": 0, "seconds": 0.0})
+            row["count"] += 1
+            row["seconds"] += seconds
+            for item, n in counts.items():
+                row[item] = row.get(item, 0) + n
+        return sorted(totals.values(), key=lambda r: r["seconds"], reverse=True)
+
+    def hit_rates(self):
+        """Hit rate for every `<name>.hit` / `<name>.miss` counter pair."""
+        with self._lock:
+            counters = dict(self.counters)
+        rates = {}
+        for key, hits in counters.items():
+            if key.endswith(".hit"):
+                name = key[:-len(".hit")]
+                total = hits + counters.get(f"{name}.miss", 0)
+                rates[name] = hits / total if total else 0.0
+        return rates
+
+    def to_json(self):
+        with self._lock:
+            stages = {name: dict(s, items=dict(s["items"])) for name, s in self.stages.items()}
+            counters = dict(self.counters)
+        return json.dumps({"stages": stages, "counters": counters, "hit_rates": self.hit_rates()}, indent=2)
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP notes_ai_stage_seconds Time spent per pipeline stage.",
+            "# TYPE notes_ai_stage_seconds summary",
+        ]
+        with self._lock:
+            stages = {name: dict(s, items=dict(s["items"])) for name, s in self.stages.items()}
+            counters = dict(self.counters)
+        for name, s in sorted(stages.items()):
+            lines.append(f'notes_ai_stage_seconds_count{{stage="{name}"}} {s["count"]}')
+            lines.append(f'notes_ai_stage_seconds_sum{{stage="{name}"}} {s["seconds"]:.6f}')
+        lines += ["# HELP notes_ai_stage_items_total Items processed per stage.",
+                  "# TYPE notes_ai_stage_items_total counter"]
+        for name, s in sorted(stages.items()):
+            for item, n in sorted(s["items"].items()):
+                lines.append(f'notes_ai_stage_items_total{{stage="{name}",item="{item}"}} {n:g}')
+        lines += ["# HELP notes_ai_events_total Event counters such as cache hits and misses.",
+                  "# TYPE notes_ai_events_total counter"]
+        for name, n in sorted(counters.items()):
+            lines.append(f'notes_ai_events_total{{event="{name}"}} {n:g}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _Span:
+    __slots__ = ("name", "counts", "start")
+
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+
+    def add(self, **counts):
+        for item, n in counts.items():
+            self.counts[item] = self.counts.get(item, 0) + n
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registry.record(self.name, time.perf_counter() - self.start, self.counts)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable(on=True):
+    global _forced
+    _forced = on
+
+
+def hold(owner, on=True):
+    """
+    Keep metrics on while at least one `owner` (e.g. a UI session showing
+    timings) wants them. A hold lapses after HOLD_SECONDS unless renewed by
+    calling hold() again, so owners that vanish without releasing don't keep
+    metrics on. Releasing never turns off metrics enabled for the whole
+    process.
+    """
+    global _held_until
+    with _holders_lock:
+        now = time.monotonic()
+        if on:
+            _holders[owner] = now + HOLD_SECONDS
+        else:
+            _holders.pop(owner, None)
+        for other, until in list(_holders.items()):
+            if until <= now:
+                del _holders[other]
+        _held_until = max(_holders.values(), default=0.0)
+
+
+def enabled():
+    # Lapsed holders are only dropped by the next hold(); their deadlines have passed either way
+    return _forced or time.monotonic() < _held_until
+
+
+def forced():
+    """Whether metrics are on for the whole process rather than only held by some users."""
+    return _forced
+
+
+def span(name, **counts):
+    """
+    Time a stage: `with span("ocr.readtext", clips=1) as s: ...`. Counts can
+    be added later with s.add(...). A shared no-op when metrics are disabled.
+    """
+    return _Span(name, counts) if enabled() else _NULL_SPAN
+
+
+def incr(name, n=1):
+    if enabled():
+        registry.incr(name, n)
+
+
+def serve(port):
+    """Serve registry.to_prometheus() at http://0.0.0.0:<port>/metrics on a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("/metrics", ""):
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("content-type", "text/plain; version=0.0.4")
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    return httpd
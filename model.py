@@ -0,0 +1,164 @@
+import json
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for to_msgpack/from_msgpack
+    msgpack = None
+
+FIELDS = ("page", "type", "text", "context", "key", "priority")
+FORMAT_VERSION = 1
+
+
+class Annotation:
+    """
+    One extracted annotation. Reads like the dicts it replaces
+    (annot["text"], annot.get("context")), but the slide text is looked up in
+    a page text table shared with the rest of the document instead of being
+    stored on every record.
+    """
+
+    __slots__ = ("page", "type", "text", "key", "priority", "pages")
+
+    def __init__(self, page, type, text, key, priority=1, pages=None):
+        self.page = page
+        self.type = type
+        self.text = text
+        self.key = key
+        self.priority = priority
+        self.pages = pages if pages is not None else {}
+
+    @property
+    def context(self):
+        return self.pages.get(self.page, "")
+
+    def __getitem__(self, name):
+        if name not in FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in FIELDS or name == "context":
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in FIELDS
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in FIELDS else default
+
+    def keys(self):
+        return FIELDS
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in FIELDS}
+
+    def __eq__(self, other):
+        if isinstance(other, (Annotation, dict)):
+            return self.to_dict() == {name: other.get(name) for name in FIELDS}
+        return NotImplemented
+
+    def __reduce__(self):
+        # Positional args pickle smaller than the default slot-state dict
+        return Annotation, (self.page, self.type, self.text, self.key, self.priority, self.pages)
+
+    def __repr__(self):
+        return f"Annotation(page={self.page!r}, type={self.type!r}, key={self.key!r}, text={self.text[:40]!r})"
+
+
+class AnnotatedDocument(dict):
+    """
+    {page_number: [Annotation, ...]} for one document, plus `page_texts`,
+    the {page_number: slide text} table its records share. Serializes
+    column-wise: one list per field, annotation types as indices into a
+    small vocabulary, and each page's text once.
+    """
+
+    def __init__(self, slides=None, page_texts=None):
+        super().__init__()
+        self.page_texts = page_texts if page_texts is not None else {}
+        if slides:
+            self.merge(slides)
+
+    def merge(self, slides):
+        """Add the pages of another document (or plain {page: [annotation]} mapping)."""
+        dict.update(self, slides)
+        for page_number, annotations in slides.items():
+            if annotations and page_number not in self.page_texts:
+                self.page_texts[page_number] = annotations[0]["context"]
+        return self
+
+    def prune(self):
+        """Drop the text of pages that no longer have annotations."""
+        for page_number in [n for n in self.page_texts if n not in self]:
+            del self.page_texts[page_number]
+        return self
+
+    def dedupe_keys(self):
+        """
+        Make keys unique across the document: identical annotations on
+        identical slides get the same content-derived key, so later
+        occurrences (in page order) get a -1, -2, ... suffix.
+        """
+        used = set()
+        for annotation in self.annotations():
+            key, n = annotation.key, 0
+            while annotation.key in used:
+                n += 1
+                annotation.key = f"{key}-{n}"
+            used.add(annotation.key)
+        return self
+
+    def annotations(self):
+        return [a for annotations in self.values() for a in annotations]
+
+    def to_columns(self):
+        annotations = self.annotations()
+        types = sorted({a["type"] for a in annotations})
+        type_index = {t: i for i, t in enumerate(types)}
+        pages = {}
+        for a in annotations:
+            pages.setdefault(a["page"], a["context"])
+        return {
+            "version": FORMAT_VERSION,
+            "pages": [[n, text] for n, text in pages.items()],
+            "types": types,
+            "columns": {
+                "page": [a["page"] for a in annotations],
+                "type": [type_index[a["type"]] for a in annotations],
+                "text": [a["text"] for a in annotations],
+                "key": [a["key"] for a in annotations],
+                "priority": [a["priority"] for a in annotations],
+            },
+        }
+
+    @classmethod
+    def from_columns(cls, data):
+        if data.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported document format version: {data.get('version')}")
+        document = cls(page_texts={n: text for n, text in data["pages"]})
+        columns = data["columns"]
+        types = data["types"]
+        for page, type_i, text, key, priority in zip(columns["page"], columns["type"], columns["text"],
+                                                     columns["key"], columns["priority"]):
+            annotation = Annotation(page, types[type_i], text, key, priority, document.page_texts)
+            dict.setdefault(document, page, []).append(annotation)
+        return document
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_columns(), ensure_ascii=False, separators=(",", ":"), **kwargs)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls.from_columns(json.loads(data))
+
+    def to_msgpack(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed; use to_json() or `pip install msgpack`")
+        return msgpack.packb(self.to_columns(), use_bin_type=True)
+
+    @classmethod
+    def from_msgpack(cls, data):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed; use from_json() or `pip install msgpack`")
+        return cls.from_columns(msgpack.unpackb(data, raw=False))
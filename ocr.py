@@ -1,96 +1,482 @@
 from PIL import Image
 import io
+import os
+import json
+import hashlib
+import math
+import queue
+import threading
+from contextlib import closing
+from importlib.metadata import PackageNotFoundError, version
 import pymupdf
 import cv2
 import numpy as np
-import easyocr
+from cache import DiskCache
+import metrics
+from model import Annotation
+from utils import page_fingerprint
+from ingest import MUPDF_LOCK, release_page_cache
 
-reader = easyocr.Reader(['en'], gpu=False)
+OCR_LANGS = ['en']
+OCR_BATCH_SIZE = int(os.getenv("NOTES_AI_OCR_BATCH_SIZE", "16"))
+
+# Ink clips are rendered about CLIP_TARGET_PX tall: short one-line clips are
+# upscaled for the detector, large ones rendered no finer than they need
+CLIP_TARGET_PX = int(os.getenv("NOTES_AI_CLIP_TARGET_PX", "36"))
+CLIP_MIN_SCALE = 1.0
+CLIP_MAX_SCALE = 3.0
+CLIP_MAX_PIXELS = 2_000_000
+# Clips thinner than this (in points) can't hold legible text
+MIN_CLIP_POINTS = 6
+# A pixel is ink when its grey level is this far from the clip's background
+INK_CONTRAST = 64
+MIN_INK_FRACTION = 0.002
+# Ink confined to a band this thin (in points), and at least LINE_MIN_ASPECT
+# times as long, is a rule or stroke rather than writing (unlike "1" or "l")
+MAX_LINE_POINTS = 3
+LINE_MIN_ASPECT = 12
+
+# Handwriting text that is an error message rather than a result
+OCR_ERROR_PREFIX = "⚠️ OCR Error: "
+
+_reader = None
+_reader_lock = threading.Lock()
+_engine_version = None
+
+def get_reader():
+    """
+    Process-wide EasyOCR reader, built on first use. Importing easyocr pulls
+    in torch and loading the models costs seconds and hundreds of MB, so
+    documents that never need OCR never pay for it.
+    """
+    global _reader
+    if _reader is None:
+        with _reader_lock:
+            if _reader is None:
+                import easyocr
+                _reader = easyocr.Reader(OCR_LANGS, gpu=False)
+    return _reader
+
+def engine_version():
+    """
+    Installed easyocr version, part of every OCR cache key. Looked up once:
+    scanning package metadata per clip is slow. None if it isn't installed.
+    """
+    global _engine_version
+    if _engine_version is None:
+        try:
+            _engine_version = version("easyocr")
+        except PackageNotFoundError:
+            _engine_version = ""
+    return _engine_version or None
+
+def prewarm_reader():
+    """Start loading the reader in a background thread."""
+    thread = threading.Thread(target=get_reader, name="ocr-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+ocr_cache = DiskCache("ocr", max_bytes=int(os.getenv("NOTES_AI_OCR_CACHE_MB", "256")) * 1024 * 1024)
+
+def ocr_cache_key(image_bytes, **settings):
+    """
+    Content address for an OCR result: rendered image bytes (or an RGB
+    array, hashed in place) + engine + settings.
+    """
+    if isinstance(image_bytes, np.ndarray):
+        # Same digest as image.tobytes() + str(image.shape).encode(), without the copy
+        digest = hashlib.sha256(np.ascontiguousarray(image_bytes).data)
+        digest.update(str(image_bytes.shape).encode())
+    else:
+        digest = hashlib.sha256(image_bytes)
+    engine = {"engine": "easyocr", "version": engine_version(), "langs": OCR_LANGS, **settings}
+    digest.update(json.dumps(engine, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def cached_readtext(image_bytes, image=None, **settings):
+    """
+    reader.readtext with a persistent cache in front of it. `image` is the
+    decoded form of `image_bytes` when the caller already has it;
+    `image_bytes` may also be the decoded RGB array itself.
+    """
+    if isinstance(image_bytes, np.ndarray):
+        image = image_bytes
+    key = ocr_cache_key(image_bytes, **settings)
+    results = ocr_cache.get(key)
+    if results is None:
+        if image is None:
+            image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        with metrics.span("ocr.readtext", images=1):
+            results = get_reader().readtext(np.asarray(image), **settings)
+        if settings.get("detail", 1):
+            # Plain lists/floats so cache hits and misses look the same
+            results = [[np.asarray(box).tolist(), txt, float(conf)] for box, txt, conf in results]
+        ocr_cache.set(key, results)
+    return results
 
 def extract_handwritten_text(image_bytes):
     try:
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        results = reader.readtext(np.array(img), detail=0)
+        results = cached_readtext(clip_array(image_bytes), detail=0)
         return "\n".join(results).strip()
     except Exception as e:
-        return f"⚠️ OCR Error: {str(e)}"
+        return f"{OCR_ERROR_PREFIX}{str(e)}"
+
+def ocr_failed(text):
+    return text.startswith(OCR_ERROR_PREFIX)
+
+def _pad_batch(images):
+    """Pad images onto white canvases of a common size so they can be batched."""
+    h = max(img.shape[0] for img in images)
+    w = max(img.shape[1] for img in images)
+    batch = []
+    for img in images:
+        canvas = np.full((h, w, 3), 255, dtype=np.uint8)
+        canvas[:img.shape[0], :img.shape[1]] = img
+        batch.append(canvas)
+    return batch
+
+def handwriting_settings(batch_size=OCR_BATCH_SIZE):
+    """
+    Short digest of everything besides the page that decides its handwriting
+    text: OCR engine and version, clip rendering and filtering, batch size.
+    """
+    settings = {
+        "engine": "easyocr", "version": engine_version(), "langs": OCR_LANGS, "batch_size": batch_size,
+        "clip": [CLIP_TARGET_PX, CLIP_MIN_SCALE, CLIP_MAX_SCALE, CLIP_MAX_PIXELS, MIN_CLIP_POINTS,
+                 INK_CONTRAST, MIN_INK_FRACTION, MAX_LINE_POINTS, LINE_MIN_ASPECT],
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def clip_scale(rect):
+    """Render scale for an ink clip of `rect` (in points), see CLIP_TARGET_PX."""
+    scale = min(max(CLIP_TARGET_PX / max(rect.height, 1), CLIP_MIN_SCALE), CLIP_MAX_SCALE)
+    return min(scale, (CLIP_MAX_PIXELS / max(rect.width * rect.height, 1)) ** 0.5)
+
+def clip_array(clip):
+    """
+    HxWx3 uint8 view of a pymupdf.Pixmap's samples, without copying them;
+    the view is only valid while the pixmap is alive. Other clips (PNG
+    bytes, arrays) are returned unchanged.
+    """
+    if isinstance(clip, pymupdf.Pixmap):
+        return np.frombuffer(clip.samples_mv, dtype=np.uint8).reshape(clip.height, clip.width, clip.n)
+    return clip
+
+def clip_rejection(image, scale=1.0):
+    """
+    Why a rendered ink clip can't contain text, or None if it might: "blank"
+    when hardly any pixel stands out from the background, "line" when all the
+    ink fits in a long band thinner than MAX_LINE_POINTS (underlines, strikes,
+    rules).
+    """
+    grey = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    background = np.bincount(grey.ravel(), minlength=256).argmax()
+    ink = cv2.absdiff(grey, np.full_like(grey, background)) > INK_CONTRAST
+    if np.count_nonzero(ink) < MIN_INK_FRACTION * ink.size:
+        return "blank"
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    thin, long = sorted((rows[-1] - rows[0] + 1, cols[-1] - cols[0] + 1))
+    if thin <= MAX_LINE_POINTS * scale and long >= LINE_MIN_ASPECT * thin:
+        return "line"
+    return None
+
+def render_clip(page, rect):
+    """
+    Rasterize an ink clip for OCR at clip_scale(rect). Returns (pixmap, None),
+    or (None, reason) when the clip is too small, blank or only a line, so
+    it is never sent to OCR.
+    """
+    if min(rect.width, rect.height) < MIN_CLIP_POINTS:
+        return None, "tiny"
+    scale = clip_scale(rect)
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(scale, scale), clip=rect, alpha=False)
+    if pix.width == 0 or pix.height == 0:
+        # Rect outside the page: nothing rendered
+        return None, "blank"
+    reason = clip_rejection(clip_array(pix), scale)
+    return (None, reason) if reason else (pix, None)
+
+def _size_bucket(shape):
+    # Heights within 16 px and widths within a factor of 1.25 of each other
+    height, width = shape[:2]
+    return height // 16, int(math.log(max(width, 1), 1.25))
 
-def detect_highlighted_text_from_pil_image(pil_image):
+def extract_handwritten_text_batch(images_bytes, batch_size=OCR_BATCH_SIZE):
     """
-    Given a PIL image, detect yellow highlights and extract text via OCR.
-    Returns a list of extracted highlighted text snippets.
+    Batched counterpart of extract_handwritten_text: returns one text per
+    input image (PNG bytes or a render_clip pixmap), in order. Cache misses
+    are grouped by height and width and sent through reader.readtext_batched
+    `batch_size` clips at a time, with the recognizer batched as well.
     """
-    img = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    images_bytes = [clip_array(c) for c in images_bytes]
+    texts = [None] * len(images_bytes)
+    keys = [ocr_cache_key(b, detail=0) for b in images_bytes]
+    cached = ocr_cache.get_many(set(keys))
+    misses = []
+    for i, key in enumerate(keys):
+        if key in cached:
+            texts[i] = "\n".join(cached[key]).strip()
+        else:
+            misses.append(i)
+
+    decoded = {}
+    for i in misses:
+        if isinstance(images_bytes[i], np.ndarray):
+            decoded[i] = images_bytes[i]
+            continue
+        try:
+            decoded[i] = np.array(Image.open(io.BytesIO(images_bytes[i])).convert("RGB"))
+        except Exception as e:
+            texts[i] = f"{OCR_ERROR_PREFIX}{str(e)}"
+    # Clips only share a batch with clips of similar height and width, which
+    # keeps padding (and wasted detector work) small
+    groups = {}
+    for i in sorted(decoded, key=lambda i: decoded[i].shape[:2]):
+        groups.setdefault(_size_bucket(decoded[i].shape), []).append(i)
+    chunks = [group[start:start + max(1, batch_size)]
+              for group in groups.values() for start in range(0, len(group), max(1, batch_size))]
+    for chunk in chunks:
+        try:
+            with metrics.span("ocr.readtext_batched", images=len(chunk)):
+                # batch_size also batches the recognizer, which otherwise runs one text box at a time
+                batch_results = get_reader().readtext_batched(_pad_batch([decoded[i] for i in chunk]), detail=0,
+                                                              batch_size=max(1, batch_size))
+        except Exception:
+            for i in chunk:
+                texts[i] = extract_handwritten_text(images_bytes[i])
+            continue
+        ocr_cache.set_many({keys[i]: results for i, results in zip(chunk, batch_results)})
+        for i, results in zip(chunk, batch_results):
+            texts[i] = "\n".join(results).strip()
+    return texts
 
-    # Tune yellow range as needed
-    lower_yellow = np.array([15, 50, 150])
-    upper_yellow = np.array([45, 255, 255])
+# OpenCV HSV bounds (hue 0-179) for common highlighter colours. Blue caps
+# saturation so that saturated blue text and links aren't picked up.
+HIGHLIGHT_COLORS = {
+    "yellow": ((15, 50, 150), (45, 255, 255)),
+    "green": ((46, 50, 150), (85, 255, 255)),
+    "blue": ((86, 40, 150), (130, 200, 255)),
+    "pink": ((140, 40, 150), (175, 255, 255)),
+}
+MIN_HIGHLIGHT_AREA = 500
+MIN_HIGHLIGHT_COVERAGE = 0.5
 
-    mask = cv2.inRange(hsv, lower_yellow, upper_yellow)
+def highlight_mask(rgb, colors=None):
+    """Binary mask of highlighter-coloured regions, ignoring specks under MIN_HIGHLIGHT_AREA."""
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+    mask = np.zeros(hsv.shape[:2], dtype=np.uint8)
+    for name in (colors or HIGHLIGHT_COLORS):
+        lower, upper = HIGHLIGHT_COLORS[name]
+        mask |= cv2.inRange(hsv, np.array(lower), np.array(upper))
     kernel = np.ones((5, 5), np.uint8)
     mask = cv2.dilate(mask, kernel, iterations=1)
     mask = cv2.erode(mask, kernel, iterations=1)
 
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    keep = stats[:, cv2.CC_STAT_WIDTH] * stats[:, cv2.CC_STAT_HEIGHT] >= MIN_HIGHLIGHT_AREA
+    keep[0] = False
+    labels[~keep[labels]] = 0
+    return labels, stats
 
-    highlighted_texts = []
+def detect_highlighted_text_from_pil_image(pil_image, ocr_results=None, colors=None):
+    """
+    Given a PIL image and the page's detail=1 OCR results, return the text
+    snippets covered by highlighter colour, top to bottom. Words are matched
+    to highlighted regions by mask coverage of their OCR box, so no extra
+    OCR pass is needed. `colors` restricts detection to some of
+    HIGHLIGHT_COLORS (default: all of them).
+    """
+    rgb = np.ascontiguousarray(np.array(pil_image.convert("RGB")))
+    if ocr_results is None:
+        ocr_results = cached_readtext(rgb.tobytes() + str(rgb.shape).encode(), rgb, detail=1)
+    if not ocr_results:
+        return []
 
-    for cnt in contours:
-        x, y, w, h = cv2.boundingRect(cnt)
-        if w * h < 500:
-            continue
-        roi = img[y:y+h, x:x+w]
-        roi_pil = Image.fromarray(cv2.cvtColor(roi, cv2.COLOR_BGR2RGB))
-        results = reader.readtext(np.array(roi_pil), detail=0)
-        text = " ".join(results).strip()
-        if text:
-            highlighted_texts.append((y, text))
+    labels, stats = highlight_mask(rgb, colors)
+    h, w = labels.shape
+    boxes = np.array([np.asarray(box, dtype=float).reshape(4, 2) for box, _, _ in ocr_results])
+    x0 = np.clip(np.floor(boxes[:, :, 0].min(axis=1)), 0, w).astype(int)
+    x1 = np.clip(np.ceil(boxes[:, :, 0].max(axis=1)), 0, w).astype(int)
+    y0 = np.clip(np.floor(boxes[:, :, 1].min(axis=1)), 0, h).astype(int)
+    y1 = np.clip(np.ceil(boxes[:, :, 1].max(axis=1)), 0, h).astype(int)
+
+    # Highlighted pixels inside every OCR box at once, via a summed-area table
+    integral = cv2.integral((labels > 0).astype(np.uint8))
+    covered = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    area = (x1 - x0) * (y1 - y0)
+    hits = np.flatnonzero((area > 0) & (covered >= MIN_HIGHLIGHT_COVERAGE * np.maximum(area, 1)))
+
+    regions = {}
+    for i in hits:
+        region_labels = labels[y0[i]:y1[i], x0[i]:x1[i]].ravel()
+        region = np.bincount(region_labels[region_labels > 0]).argmax()
+        regions.setdefault(region, []).append(ocr_results[i][1])
 
     # Sort top to bottom
-    highlighted_texts.sort(key=lambda x: x[0])
+    highlighted_texts = sorted(
+        (stats[region, cv2.CC_STAT_TOP], " ".join(words).strip()) for region, words in regions.items()
+    )
     final_texts = []
     seen = set()
     for _, txt in highlighted_texts:
-        if txt not in seen:
+        if txt and txt not in seen:
             final_texts.append(txt)
             seen.add(txt)
     return final_texts
 
-def run_full_page_ocr(doc, st):
-    annotations_by_slide = {}
-    for page_number, page in enumerate(doc, start=1):
-        st.write(f"🔍 Running OCR on Slide {page_number}...")
+_DONE = object()
+
+def _put(q, item, stop):
+    """Blocking put that gives up once `stop` is set, so stages never hang on a dead consumer."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
 
+def _get(q, stop):
+    while not stop.is_set():
         try:
-            pix = page.get_pixmap(matrix=pymupdf.Matrix(2, 2), alpha=False)
-            img_bytes = pix.tobytes("png")
-            st.image(img_bytes, caption=f"Slide {page_number} - Rendered Image")
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
 
-            image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-            results = reader.readtext(np.array(image), detail=0)
-            text = "\n".join(results).strip()
+def _render_stage(doc, pages, renderer, doc_hash, out, stop):
+    """
+    Fingerprint each page as it comes up and render it unless its result is
+    already in `ocr_cache`. Puts (page_number, fingerprint, img_bytes, stored, error).
+    """
+    try:
+        for page_number in pages:
+            if stop.is_set():
+                return
+            fingerprint = None
+            try:
+                # Scanned pages only differ in their images, so those are fingerprinted too
+                with MUPDF_LOCK:
+                    fingerprint = page_fingerprint(doc[page_number - 1], images=True)[1]
+                stored = ocr_cache.get(_page_key(fingerprint))
+                if stored is not None:
+                    item = (page_number, fingerprint, None, stored, None)
+                else:
+                    with metrics.span("ocr.render", pages=1):
+                        if renderer is not None:
+                            img_bytes = renderer.render(doc, doc_hash, page_number, 2)
+                        else:
+                            with MUPDF_LOCK:
+                                pix = doc[page_number - 1].get_pixmap(matrix=pymupdf.Matrix(2, 2), alpha=False)
+                                img_bytes = pix.tobytes("png")
+                                del pix
+                        # Scanned pages leave large decoded images in MuPDF's cache
+                        release_page_cache()
+                    item = (page_number, fingerprint, img_bytes, None, None)
+            except Exception as e:
+                item = (page_number, fingerprint, None, None, e)
+            if not _put(out, item, stop):
+                return
+    finally:
+        _put(out, _DONE, stop)
+
+def _ocr_stage(inp, out, stop):
+    while True:
+        item = _get(inp, stop)
+        if item is _DONE:
+            _put(out, _DONE, stop)
+            return
+        page_number, fingerprint, img_bytes, stored, error = item
+        if error is None and stored is None:
+            try:
+                image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+                item = (page_number, fingerprint, image, cached_readtext(img_bytes, image, detail=1), None, None)
+            except Exception as e:
+                item = (page_number, fingerprint, None, None, None, e)
+        else:
+            item = (page_number, fingerprint, None, None, stored, error)
+        if not _put(out, item, stop):
+            return
+
+def _page_key(fingerprint):
+    # Same engine/settings versioning as clip results, keyed by page fingerprint
+    return ocr_cache_key(fingerprint.encode(), scale=2, full_page=True)
+
+def iter_full_page_ocr(doc, renderer=None, doc_hash=None, pages=None, cancel=None, queue_size=2):
+    """
+    OCR fallback as a pipeline: pages are rendered, OCR'd and scanned for
+    highlights in overlapping stages joined by queues of `queue_size`, so at
+    most a few page images are alive at once whatever the document length.
+
+    Yields (page_number, annotations, highlighted_texts, error) in page order
+    as soon as each page is done. `pages` limits the run to some 1-based page
+    numbers. Setting the `cancel` event, or closing the generator, stops all
+    stages. See run_full_page_ocr for `renderer` and `doc_hash`.
 
-            if not text:
-                text = "(No readable OCR text found on this page.)"
+    Finished pages are kept in `ocr_cache` by page fingerprint, so pages seen
+    before (in this or an earlier version of the deck) skip rendering and OCR.
+    Pages are fingerprinted one at a time on the render thread, so the first
+    slide doesn't wait for the whole file to be read.
+    """
+    pages = list(range(1, doc.page_count + 1)) if pages is None else list(pages)
+    # The recognised text is also each OCR annotation's context
+    page_texts = {}
+    stop = threading.Event()
+    rendered = queue.Queue(maxsize=queue_size)
+    recognised = queue.Queue(maxsize=queue_size)
+    stages = [
+        threading.Thread(target=_render_stage, args=(doc, pages, renderer, doc_hash, rendered, stop),
+                         name="ocr-render", daemon=True),
+        threading.Thread(target=_ocr_stage, args=(rendered, recognised, stop), name="ocr-recognise", daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+    try:
+        for _ in pages:
+            if cancel is not None and cancel.is_set():
+                break
+            item = _get(recognised, stop)
+            if item is _DONE:
+                break
+            page_number, fingerprint, image, results, stored, error = item
+            if error is not None:
+                yield page_number, None, [], error
+                continue
+            if stored is not None:
+                text, highlighted_texts = stored["text"], stored["highlights"]
+            else:
+                text = "\n".join(txt for _, txt, _ in results).strip()
+                if not text:
+                    text = "(No readable OCR text found on this page.)"
+                with metrics.span("ocr.highlights", pages=1):
+                    highlighted_texts = detect_highlighted_text_from_pil_image(image, results)
+                del image
+                ocr_cache.set(_page_key(fingerprint), {"text": text, "highlights": highlighted_texts})
+            page_texts[page_number] = text
+            key = f"ocr-{fingerprint[:16]}"
+            annotation_data = Annotation(page_number, "OCR", text, key, 0, page_texts)
+            yield page_number, [annotation_data], highlighted_texts, None
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join(timeout=5)
 
-            highlighted_texts = detect_highlighted_text_from_pil_image(image)
+def run_full_page_ocr(doc, st, renderer=None, doc_hash=None):
+    """
+    OCR every page of `doc`. With a render.RenderCache as `renderer`, the 2x
+    page renders are taken from (and left in) that cache under `doc_hash`.
+    """
+    annotations_by_slide = {}
+    with closing(iter_full_page_ocr(doc, renderer, doc_hash)) as pages:
+        for page_number, annotations, highlighted_texts, error in pages:
+            if error is not None:
+                st.error(f"❌ Error on slide {page_number}: {error}")
+                continue
+            st.write(f"🔍 OCR done for Slide {page_number}")
             if highlighted_texts:
-                st.write("Detected highlighted text snippets via color detection + OCR:")
+                st.write("Detected highlighted text snippets via color detection:")
                 for i, snippet in enumerate(highlighted_texts, 1):
                     st.write(f"{i}. {snippet}")
-
-            key = f"{page_number}-ocr"
-            annotation_data = {
-                "page": page_number,
-                "type": "OCR",
-                "text": text,
-                "context": text,
-                "key": key,
-                "priority": 0
-            }
-            annotations_by_slide[page_number] = [annotation_data]
-
-        except Exception as e:
-            st.error(f"❌ Error on slide {page_number}: {e}")
+            annotations_by_slide[page_number] = annotations
     return annotations_by_slide
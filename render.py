@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+import pymupdf
+from ingest import MUPDF_LOCK, open_document
+
+RENDER_BUDGET_MB = int(os.getenv("NOTES_AI_RENDER_BUDGET_MB", "128"))
+VIEWER_SCALE = 1.5
+OCR_SCALE = 2
+THUMBNAIL_SCALE = 0.2
+PREFETCH_RADIUS = 2
+
+
+class RenderCache:
+    """
+    Rendered page images (PNG bytes) keyed by (doc_hash, page_number, scale),
+    evicted least recently used first once they exceed `max_bytes`.
+
+    PyMuPDF is not thread-safe, even across documents, so every render made
+    through the cache holds ingest.MUPDF_LOCK, including background
+    prefetches, which open their own copy of the document. Code that calls
+    MuPDF on other threads while prefetches may run (the app's script
+    thread, the OCR render stage) must hold the same lock.
+    """
+
+    def __init__(self, max_bytes=RENDER_BUDGET_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._render_lock = MUPDF_LOCK
+        self._prefetching = set()
+
+    def get(self, doc_hash, page_number, scale, reuse_larger=False):
+        """
+        Cached image or None. With `reuse_larger`, a render at a higher scale
+        is an acceptable answer (the viewer downsizes on display anyway).
+        """
+        with self._lock:
+            key = (doc_hash, page_number, scale)
+            if key not in self._images and reuse_larger:
+                larger = [k for k in self._images if k[:2] == key[:2] and k[2] > scale]
+                key = min(larger, key=lambda k: k[2]) if larger else key
+            if key not in self._images:
+                self.misses += 1
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return self._images[key]
+
+    def put(self, doc_hash, page_number, scale, image):
+        with self._lock:
+            key = (doc_hash, page_number, scale)
+            if key in self._images:
+                self._bytes -= len(self._images.pop(key))
+            self._images[key] = image
+            self._bytes += len(image)
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def render(self, doc, doc_hash, page_number, scale, reuse_larger=False):
+        """PNG of 1-based `page_number` at `scale`, rendered only on a cache miss."""
+        image = self.get(doc_hash, page_number, scale, reuse_larger)
+        if image is None:
+            with self._render_lock:
+                pix = doc[page_number - 1].get_pixmap(matrix=pymupdf.Matrix(scale, scale), alpha=False)
+                image = pix.tobytes("png")
+            self.put(doc_hash, page_number, scale, image)
+        return image
+
+    def thumbnail(self, doc, doc_hash, page_number):
+        return self.render(doc, doc_hash, page_number, THUMBNAIL_SCALE)
+
+    def prefetch(self, source, doc_hash, page_numbers, scales=(VIEWER_SCALE, THUMBNAIL_SCALE)):
+        """
+        Render `page_numbers` at `scales` on a background thread, opening the
+        document from `source` (a path, or bytes). Returns the thread, if one was started.
+        """
+        wanted = [(p, s) for p in page_numbers for s in scales
+                  if (doc_hash, p, s) not in self._images]
+        with self._lock:
+            wanted = [w for w in wanted if (doc_hash,) + w not in self._prefetching]
+            self._prefetching.update((doc_hash,) + w for w in wanted)
+        if not wanted:
+            return None
+
+        def run():
+            doc = None
+            try:
+                with MUPDF_LOCK:
+                    doc = open_document(source)
+                    page_count = doc.page_count
+                for page_number, scale in wanted:
+                    if 1 <= page_number <= page_count:
+                        self.render(doc, doc_hash, page_number, scale, reuse_larger=scale != THUMBNAIL_SCALE)
+            finally:
+                if doc is not None:
+                    with MUPDF_LOCK:
+                        doc.close()
+                with self._lock:
+                    self._prefetching.difference_update((doc_hash,) + w for w in wanted)
+
+        thread = threading.Thread(target=run, name="render-prefetch", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._images), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+def neighbours(page_numbers, current, radius=PREFETCH_RADIUS):
+    """Up to `radius` entries of `page_numbers` either side of `current`."""
+    index = page_numbers.index(current)
+    return page_numbers[max(0, index - radius):index] + page_numbers[index + 1:index + 1 + radius]
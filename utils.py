@@ -1,26 +1,104 @@
 import pymupdf
 import hashlib
+import re
+import numpy as np
+import metrics
 
 def get_annot_hash(annotation, context, slide, typ):
     return hashlib.sha256(f"{annotation}|{context}|{slide}|{typ}".encode()).hexdigest()
 
-def extract_highlighted_text(page, annot):
+# References to the page, parent, popup and reply-to objects are xref numbers,
+# which change whenever the PDF is re-saved; they say nothing about content
+_PARENT_REFS = re.compile(rb"/(P|Parent|Popup|IRT)\s*\d+\s+\d+\s+R")
+_REFS = re.compile(rb"\d+\s+\d+\s+R")
+
+def annotation_fingerprint(doc, xref):
+    """Hash of an annotation's dictionary (minus object numbers) and its appearance stream."""
+    digest = hashlib.sha256()
+    source = _PARENT_REFS.sub(b"", doc.xref_object(xref, compressed=True).encode())
+    digest.update(_REFS.sub(b"R", source))
+    kind, value = doc.xref_get_key(xref, "AP/N")
+    if kind == "xref":
+        digest.update(doc.xref_stream(int(value.split()[0])) or b"")
+    return digest.hexdigest()
+
+def page_fingerprint(page, images=False):
+    """
+    Fingerprints of a page, independent of its position in the document:
+    (content, page, {annotation xref: annotation fingerprint}). `content`
+    covers the content stream and form XObjects, plus the raw image streams
+    when `images` is set (scanned pages draw nothing but an image); `page`
+    also covers every annotation.
+    """
+    doc = page.parent
+    content = hashlib.sha256(page.read_contents())
+    content.update(str(tuple(page.rect)).encode())
+    for xref, *_ in page.get_xobjects():
+        content.update(doc.xref_stream(xref) or b"")
+    if images:
+        for xref, *_ in page.get_images():
+            content.update(doc.xref_stream_raw(xref) or b"")
+    content = content.hexdigest()
+    annots = {xref: annotation_fingerprint(doc, xref) for xref, *_ in page.annot_xrefs()}
+    whole = hashlib.sha256(content.encode())
+    for fingerprint in annots.values():
+        whole.update(fingerprint.encode())
+    return content, whole.hexdigest(), annots
+
+def annotation_key(content_fingerprint, annot_fingerprint, seen=None):
+    """
+    Stable annotation key: the same annotation on an unchanged slide gets the
+    same key wherever the slide moves. `seen` disambiguates exact duplicates.
+    """
+    key = hashlib.sha256(f"{content_fingerprint}|{annot_fingerprint}".encode()).hexdigest()[:16]
+    if seen is not None:
+        n = seen.get(key, 0)
+        seen[key] = n + 1
+        if n:
+            key = f"{key}-{n}"
+    return key
+
+class PageWordIndex:
+    """
+    Word boxes of a single page, extracted once and shared by every
+    highlight on that page. Overlap tests are vectorized with NumPy.
+    """
+
+    def __init__(self, page):
+        with metrics.span("highlights.index") as s:
+            words = page.get_text("words")
+            s.add(words=len(words))
+        self.words = [w[4] for w in words]
+        self.rects = np.array([w[:4] for w in words], dtype=float).reshape(-1, 4)
+        self.areas = (self.rects[:, 2] - self.rects[:, 0]) * (self.rects[:, 3] - self.rects[:, 1])
+
+    def words_in(self, highlight_rects, min_overlap=0.5):
+        """
+        For each highlight rect, return the words (in page order) whose box
+        is covered by more than `min_overlap` of its own area.
+        """
+        if not len(self.words) or not len(highlight_rects):
+            return [[] for _ in highlight_rects]
+        hl = np.array(highlight_rects, dtype=float).reshape(-1, 4)[:, None, :]
+        w = self.rects[None, :, :]
+        iw = np.clip(np.minimum(hl[..., 2], w[..., 2]) - np.maximum(hl[..., 0], w[..., 0]), 0, None)
+        ih = np.clip(np.minimum(hl[..., 3], w[..., 3]) - np.maximum(hl[..., 1], w[..., 1]), 0, None)
+        overlap = iw * ih
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hits = (self.areas > 0) & (overlap / self.areas > min_overlap)
+        return [[self.words[j] for j in np.flatnonzero(row)] for row in hits]
+
+def extract_highlighted_text(page, annot, word_index=None):
+    if word_index is None:
+        word_index = PageWordIndex(page)
     quads = annot.vertices
     quad_count = int(len(quads) / 4)
+    highlight_rects = [tuple(pymupdf.Quad(quads[i*4:(i+1)*4]).rect) for i in range(quad_count)]
+
+    with metrics.span("highlights.resolve", quads=quad_count):
+        words_per_quad = word_index.words_in(highlight_rects)
     highlighted_chunks = []
-    words = page.get_text("words")
-
-    for i in range(quad_count):
-        highlight_rect = pymupdf.Quad(quads[i*4:(i+1)*4]).rect
-        chunk_words = []
-        for word in words:
-            word_rect = pymupdf.Rect(word[:4])
-            intersect = word_rect & highlight_rect
-            if intersect:
-                word_area = word_rect.width * word_rect.height
-                overlap_area = intersect.width * intersect.height
-                if overlap_area / word_area > 0.5:
-                    chunk_words.append(word[4])
+    for chunk_words in words_per_quad:
         chunk = " ".join(chunk_words)
         if chunk and len(chunk) > 2:
             highlighted_chunks.append(chunk)